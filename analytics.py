@@ -0,0 +1,220 @@
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+from clock import SIMULATION_RATE
+from mesh_cache import MORPH_SETS, load_indexed_mesh
+from model import HEART_MESH, Heart
+from partition import REGION_MESHES, load_partitioned_mesh
+import rhythm
+
+# numbers out of the simulation, without a GL context: the mesh at any moment is
+# base + weights @ deltas with the weights update_vertex uses, so the volume enclosed by
+# the mesh is a cubic polynomial of the weights whose 4x4x4 coefficients are summed over
+# the triangles once, and every sample after that costs a few dozen multiply-adds
+
+# samples whose displacements are computed at once, (chunk, vertices, 3) float32
+DISPLACEMENT_CHUNK = 256
+
+
+def close_holes(indices, count):
+    # triangles with every open boundary loop fanned to a new vertex at its center, and
+    # the vertices of each loop; the center is the mean of the loop so it morphs with it
+    triangles = np.asarray(indices, dtype='i8').reshape(-1, 3)
+    edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+    _, inverse, counts = np.unique(np.sort(edges, axis=1), axis=0, return_inverse=True, return_counts=True)
+    boundary = edges[counts[inverse.ravel()] == 1]
+    # loops: connected components of the boundary edges, labelled by their lowest vertex
+    labels = np.arange(count)
+    while True:
+        lowest = np.minimum(labels[boundary[:, 0]], labels[boundary[:, 1]])
+        updated = labels.copy()
+        np.minimum.at(updated, boundary[:, 0], lowest)
+        np.minimum.at(updated, boundary[:, 1], lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    loop_labels, loop_of_edge = np.unique(labels[boundary[:, 0]], return_inverse=True)
+    loops = [np.unique(boundary[loop_of_edge == i]) for i in range(len(loop_labels))]
+    # reversed boundary edge + center keeps the winding of the triangle it borders
+    fans = np.column_stack([boundary[:, 1], boundary[:, 0], count + loop_of_edge])
+    return np.vstack([triangles, fans]), loops
+
+
+def position_basis(vertex_data, targets):
+    # (1 + targets, vertices, 3): base positions and the position delta of each target
+    base = np.asarray(vertex_data, dtype='f8').reshape(-1, 8)[:, 5:]
+    deltas = [np.asarray(target, dtype='f8').reshape(-1, 8)[:, 5:] - base for target in targets]
+    return np.stack([base, *deltas])
+
+
+def volume_coefficients(triangles, loops, basis):
+    # volume(w) = sum over l, m, n of w_l w_m w_n c[l, m, n] (w_0 = 1): the signed
+    # tetrahedra a . (b x c) / 6 of the closed mesh expanded in the basis
+    centers = np.stack([basis[:, loop].mean(axis=1) for loop in loops], axis=1) if loops else basis[:, :0]
+    points = np.concatenate([basis, centers], axis=1)[:, triangles]
+    a, b, c = points[:, :, 0], points[:, :, 1], points[:, :, 2]
+    cross = np.cross(b[:, None], c[None, :])
+    return np.einsum('lfi,mnfi->lmn', a, cross) / 6
+
+
+def volumes(coefficients, weights):
+    # enclosed volume at each row of weights (samples, targets)
+    w = np.column_stack([np.ones(len(weights)), weights])
+    return np.einsum('lmn,sl,sm,sn->s', coefficients, w, w, w, optimize=True)
+
+
+class HeartAnalytics:
+    # what the analysis needs from the meshes, built once per process
+    def __init__(self, path=HEART_MESH, target_paths=MORPH_SETS[HEART_MESH]):
+        indices, vertex_data, targets = load_indexed_mesh(path, target_paths)
+        basis = position_basis(vertex_data, targets)
+        self.coefficients = volume_coefficients(*close_holes(indices, len(basis[0])), basis)
+        # the regions of the partitioned heart, each closed on its own
+        indices, vertex_data, targets, regions = load_partitioned_mesh(path, target_paths)
+        basis = position_basis(vertex_data, targets)
+        self.region_names = [os.path.splitext(os.path.basename(p))[0] for p in REGION_MESHES]
+        self.region_coefficients = []
+        for first_vertex, count, first_index, index_count in regions:
+            region_indices = np.asarray(indices[first_index:first_index + index_count], dtype='i8') - first_vertex
+            region_basis = basis[:, first_vertex:first_vertex + count]
+            self.region_coefficients.append(volume_coefficients(*close_holes(region_indices, count), region_basis))
+        self.region_starts = regions[:, 0]
+        self.region_counts = regions[:, 1]
+        self.deltas = basis[1:].astype('f4')
+
+    def displacements(self, weights, chunk=DISPLACEMENT_CHUNK):
+        # mean and largest vertex displacement of each region (samples, regions) and the
+        # largest displacement of each vertex over all the samples
+        mean = np.empty((len(weights), len(self.region_starts)))
+        largest = np.empty_like(mean)
+        peak = np.zeros(self.deltas.shape[1], dtype='f4')
+        for first in range(0, len(weights), chunk):
+            offsets = np.tensordot(weights[first:first + chunk].astype('f4'), self.deltas, axes=1)
+            distance = np.sqrt(np.einsum('svi,svi->sv', offsets, offsets))
+            mean[first:first + chunk] = np.add.reduceat(distance, self.region_starts, axis=1) / self.region_counts
+            largest[first:first + chunk] = np.maximum.reduceat(distance, self.region_starts, axis=1)
+            np.maximum(peak, distance.max(axis=0), out=peak)
+        return mean, largest, peak
+
+
+ANALYTICS = None
+
+
+def get_analytics():
+    global ANALYTICS
+    if ANALYTICS is None:
+        ANALYTICS = HeartAnalytics()
+    return ANALYTICS
+
+
+def timeline(ppm, mask, duration, rate=SIMULATION_RATE):
+    # (times, beat, phase, weights) of a heart beating at ppm with mask, rate samples a
+    # second: the simulation steps Heart runs, interpolated between steps like a frame
+    heart = Heart.__new__(Heart)  # only its animation methods run, no GL
+    heart.ppm = ppm
+    heart.set_beat_mask(list(mask))
+    heart.animation_progress_1 = heart.animation_progress_2 = heart.animation_progress_3 = 0.0
+    heart.beat_count = 0
+    steps = int(np.ceil(duration * SIMULATION_RATE)) + 1
+    # beats so far (whole beats + phase) and the weights at every step
+    positions, weights = np.empty(steps), np.empty((steps, 3))
+    for step in range(steps):
+        positions[step] = heart.beat_count + heart.animation_progress_1
+        weights[step] = heart.get_morph_weights()
+        heart.update_progress()
+    times = np.arange(round(duration * rate)) / rate
+    step = times * SIMULATION_RATE
+    position = np.interp(step, np.arange(steps), positions)
+    beat = position.astype(int)
+    frame_weights = np.stack([np.interp(step, np.arange(steps), weights[:, i]) for i in range(3)], axis=1)
+    return times, beat, position - beat, frame_weights
+
+
+def analyze(ppm, mask, duration, rate=SIMULATION_RATE):
+    # volume and wall motion of one heart over duration seconds
+    analytics = get_analytics()
+    times, beat, phase, weights = timeline(ppm, mask, duration, rate)
+    volume = volumes(analytics.coefficients, weights)
+    region_volume = np.stack([volumes(c, weights) for c in analytics.region_coefficients], axis=1)
+    displacement, peak_displacement, vertex_peak = analytics.displacements(weights)
+    # per beat: stroke volume (largest - smallest volume) and its fraction of the largest
+    starts = np.flatnonzero(np.diff(beat, prepend=-1))
+    largest, smallest = np.maximum.reduceat(volume, starts), np.minimum.reduceat(volume, starts)
+    return {
+        'time': times, 'beat': beat, 'phase': phase, 'weights': weights,
+        'volume': volume, 'region_volume': region_volume,
+        'displacement': displacement, 'peak_displacement': peak_displacement, 'vertex_peak': vertex_peak,
+        'rest_volume': analytics.coefficients[0, 0, 0],
+        'stroke_volume': largest - smallest, 'ejection_fraction': (largest - smallest) / largest,
+    }
+
+
+def sweep_runs(kinds, ppms=None, seed=None):
+    # (rhythm, ppm, mask) of every run: each rhythm's beat mask at each ppm, by default
+    # the low, middle and high end of the rhythm's range
+    _, masks = rhythm.generate(kinds, seed=seed)
+    runs = []
+    for kind, mask in zip(kinds, masks):
+        low, high = rhythm.get_rhythm(kind)[0]
+        for ppm in ppms or [low, (low + high) // 2, high]:
+            runs.append((kind, ppm, mask))
+    return runs
+
+
+def sweep(kinds, ppms=None, duration=10.0, rate=SIMULATION_RATE, seed=None, workers=1):
+    # analyze every run, split across workers processes
+    runs = sweep_runs(kinds, ppms, seed)
+    if workers == 1:
+        return runs, [analyze(ppm, mask, duration, rate) for _, ppm, mask in runs]
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as pool:
+        jobs = [pool.submit(analyze, ppm, mask, duration, rate) for _, ppm, mask in runs]
+        return runs, [job.result() for job in jobs]
+
+
+def write(runs, results, out):
+    # out.npz: one column per quantity, a row per run (time series as (runs, samples, ...));
+    # out.csv: one summary row per run
+    names = get_analytics().region_names
+    columns = {'rhythm': np.array([kind for kind, _, _ in runs]), 'ppm': np.array([ppm for _, ppm, _ in runs]),
+               'regions': np.array(names), 'time': results[0]['time']}
+    for key in ['beat', 'phase', 'weights', 'volume', 'region_volume', 'displacement', 'peak_displacement', 'vertex_peak',
+                'rest_volume']:
+        columns[key] = np.stack([result[key] for result in results])
+    # the number of beats depends on the ppm, padded with NaN
+    beats = max(len(result['stroke_volume']) for result in results)
+    for key in ['stroke_volume', 'ejection_fraction']:
+        columns[key] = np.full((len(results), beats), np.nan)
+        for row, result in zip(columns[key], results):
+            row[:len(result[key])] = result[key]
+    np.savez(f'{out}.npz', **columns)
+
+    with open(f'{out}.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['rhythm', 'ppm', 'beats', 'rest_volume', 'min_volume', 'max_volume', 'stroke_volume',
+                         'ejection_fraction', *[f'displacement_{name}' for name in names],
+                         *[f'peak_displacement_{name}' for name in names]])
+        for (kind, ppm, _), result in zip(runs, results):
+            writer.writerow([kind, ppm, len(result['stroke_volume']), result['rest_volume'], result['volume'].min(),
+                             result['volume'].max(), result['stroke_volume'].mean(), result['ejection_fraction'].mean(),
+                             *result['displacement'].mean(axis=0), *result['peak_displacement'].max(axis=0)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Heart volume and wall motion over the beat cycle for each rhythm and ppm')
+    parser.add_argument('out', help='output path without extension, writes out.npz and out.csv')
+    parser.add_argument('--rhythms', default=','.join(rhythm.RHYTHMS), help='comma separated rhythms')
+    parser.add_argument('--ppm', help='comma separated ppm for every rhythm (default: low, middle and high end of its range)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of each run')
+    parser.add_argument('--rate', type=int, default=SIMULATION_RATE, help='samples per second')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the beat masks')
+    parser.add_argument('--workers', type=int, default=1, help='processes to split the runs across')
+    args = parser.parse_args()
+
+    ppms = args.ppm and [int(p) for p in args.ppm.split(',')]
+    runs, results = sweep(args.rhythms.split(','), ppms, args.duration, args.rate, args.seed, args.workers)
+    write(runs, results, args.out)
+    print(f'{len(runs)} runs written to {args.out}.npz and {args.out}.csv')
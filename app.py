@@ -1,11 +1,16 @@
 import tkinter as tk
 from tkinter import ttk
+import tkinter.messagebox
 from main import GraphicsEngine
-import random
+from loader import AssetLoader
+from ward import ward_layout
+import numpy as np
+import rhythm
+import time
 
 
 class App:
-    def __init__(self):
+    def __init__(self, seed=None):
         self.ventana = tk.Tk()
         self.ventana.title("Simulador de Ritmos Cardiacos")
         self.ventana.geometry("600x500")
@@ -13,12 +18,21 @@ class App:
 
         self.seleccion = tk.StringVar(value="")
         self.comparacion = tk.StringVar(value="")
+        self.pacientes = tk.IntVar(value=16)
+        # ritmos reproducibles con la misma semilla
+        self.rng = np.random.default_rng(seed)
 
         self.frame_principal = tk.Frame(self.ventana, bg="#f7f7f7")
         self.frame_comparacion = tk.Frame(self.ventana, bg="#f7f7f7")
+        self.frame_carga = tk.Frame(self.ventana, bg="#f7f7f7")
 
         self.crear_pantalla_principal()
         self.crear_pantalla_comparacion()
+        self.crear_pantalla_carga()
+        self.carga = None
+        # la ventana 3D sigue abierta entre simulaciones, cada una solo cambia la escena
+        self.engine = None
+        AssetLoader.warm_up()
 
         self.mostrar_pantalla_principal()
 
@@ -41,10 +55,27 @@ class App:
                 width=20
             ).pack(pady=10)
 
+        frame_sala = tk.Frame(self.frame_principal, bg="#f7f7f7")
+        frame_sala.pack(pady=10)
+        ttk.Button(
+            frame_sala,
+            text="Sala de pacientes",
+            command=lambda: self.manejar_seleccion_principal("Sala"),
+            style="Custom.TButton",
+            width=20
+        ).pack(side="left", padx=5)
+        ttk.Spinbox(
+            frame_sala,
+            from_=1,
+            to=100,
+            textvariable=self.pacientes,
+            width=5
+        ).pack(side="left")
+
         tk.Button(
             self.frame_principal,
             text="Salir",
-            command=self.ventana.destroy,
+            command=self.salir,
             bg="#d9534f",
             fg="white",
             font=("Helvetica", 12, "bold"),
@@ -87,6 +118,31 @@ class App:
             pady=10
         ).pack(pady=20)
 
+    def crear_pantalla_carga(self):
+        tk.Label(
+            self.frame_carga,
+            text="Cargando modelos...",
+            font=("Helvetica", 14, "bold"),
+            bg="#f7f7f7",
+            fg="#333333"
+        ).pack(pady=40)
+
+        self.progreso = ttk.Progressbar(self.frame_carga, length=300, mode="determinate", maximum=100)
+        self.progreso.pack(pady=10)
+
+        tk.Button(
+            self.frame_carga,
+            text="Cancelar",
+            command=self.cancelar_carga,
+            bg="#6c757d",
+            fg="white",
+            font=("Helvetica", 12, "bold"),
+            relief="flat",
+            bd=0,
+            padx=20,
+            pady=10
+        ).pack(pady=20)
+
     def manejar_seleccion_principal(self, opcion):
         self.seleccion.set(opcion)
         if opcion == "Comparación":
@@ -96,60 +152,46 @@ class App:
 
     def mostrar_pantalla_principal(self):
         self.frame_comparacion.pack_forget()
+        self.frame_carga.pack_forget()
         self.frame_principal.pack(fill="both", expand=True)
 
     def mostrar_pantalla_comparacion(self):
         self.frame_principal.pack_forget()
         self.frame_comparacion.pack(fill="both", expand=True)
 
+    def mostrar_pantalla_carga(self):
+        self.frame_principal.pack_forget()
+        self.frame_comparacion.pack_forget()
+        self.progreso["value"] = 0
+        self.frame_carga.pack(fill="both", expand=True)
+
     def seleccionar_comparacion(self, comparacion):
         self.comparacion.set(comparacion)
         self.iniciar_simulacion()
 
-    def generar_arritmia_suavizada(self, longitud=100, rango_latido=(0.7, 1.0), rango_pausa=(0.0, 0.3), prob_latido=0.6, pasos_suavizado=5):
-        arritmia = []
-        ultimo_valor = random.uniform(*rango_pausa)  # Inicia con un valor dentro del rango de pausas
-
-        while len(arritmia) < longitud:
-            if random.random() < prob_latido:
-                proximo_valor = random.uniform(*rango_latido)
-            else:
-                proximo_valor = random.uniform(*rango_pausa)
-
-            if len(arritmia) + pasos_suavizado <= longitud:
-                transicion = [
-                    ultimo_valor + (proximo_valor - ultimo_valor) * (i / pasos_suavizado)
-                    for i in range(pasos_suavizado)
-                ]
-                arritmia.extend(transicion)
-            else:
-                arritmia.append(proximo_valor)
-
-            ultimo_valor = proximo_valor
-
-        return arritmia[:longitud]
-    
-    def generate_model(self, opcion, pos):
-        mask = [1] * 100
-        if opcion == "Normal":
-            ppm = random.randint(60,100)
-        elif opcion == "Bradicardia":
-            ppm = random.randint(30,60)
-        elif opcion == "Taquicardia":
-            ppm = random.randint(110,160)
-        elif opcion == "Arritmia":
-            ppm = random.randint(60,100)
-            mask = self.generar_arritmia_suavizada()
-
-        return [pos, (0,0,0), (1,1,1), ppm, mask] 
-
-    def get_model_data(self, opcion, comparacion):
+    def get_model_data(self, opcion, comparacion, seed=None):
         data, position = [opcion], [(0, -2, -10)]
         if comparacion:
             data = comparacion.split(" vs ")
             position = [(-0.8, -2, -10), (0.8, -2, -10)]
 
-        return [self.generate_model(opt, pos) for opt, pos in zip(data, position)]
+        # ritmo de cada latido alrededor de su ppm
+        rng = np.random.default_rng(seed)
+        ppm, masks = rhythm.generate(data, seed=rng)
+        schedules = rhythm.ppm_schedule(data, ppm, seed=rng)
+        return [[pos, (0,0,0), (1,1,1), schedule.tolist(), mask] for pos, schedule, mask in zip(position, schedules, masks)]
+
+    def get_ward_data(self, pacientes, seed=None):
+        # grid of patients with random rhythms, each one starting at its own phase
+        rng = np.random.default_rng(seed)
+        positions, scale = ward_layout(pacientes)
+        opciones = ["Normal", "Taquicardia", "Bradicardia", "Arritmia", "Fibrilacion", "Extrasistole"]
+        kinds = rng.choice(opciones, pacientes)
+        ppm, masks = rhythm.generate(kinds, seed=rng)
+        phases = rng.random(pacientes)
+        schedules = rhythm.ppm_schedule(kinds, ppm, seed=rng)
+        return [[pos, (0,0,0), scale, schedule.tolist(), mask, phase]
+                for pos, schedule, mask, phase in zip(positions, schedules, masks, phases)]
 
     def iniciar_simulacion(self):
         seleccion = self.seleccion.get()
@@ -157,10 +199,63 @@ class App:
 
         if seleccion == "Comparación" and not comparacion:
             tk.messagebox.showerror("Error", "Por favor selecciona una comparación.")
+        elif seleccion == "Sala":
+            models_data = self.get_ward_data(max(1, min(100, self.pacientes.get())), seed=self.rng)
+            self.lanzar(models_data, ward=True)
         elif seleccion:
-            models_data = self.get_model_data(seleccion, comparacion)
-            app = GraphicsEngine(models_data, win_size=(1600, 900))
-            app.run()
+            models_data = self.get_model_data(seleccion, comparacion, seed=self.rng)
+            self.lanzar(models_data)
+
+    def lanzar(self, models_data, ward=False):
+        if self.engine is not None and not self.engine.closed:
+            # sesión ya abierta: contexto y modelos cargados, solo se cambia la escena
+            self.engine.load(models_data, ward, launch_time=time.perf_counter())
+            self.engine.run()
+        else:
+            self.cargar(models_data, ward)
+
+    def cargar(self, models_data, ward=False):
+        # OBJ/PNG loading runs in the background while Tk keeps drawing the progress bar
+        self.inicio_carga = time.perf_counter()
+        self.carga = AssetLoader().start()
+        self.models_data, self.ward = models_data, ward
+        self.mostrar_pantalla_carga()
+        self.comprobar_carga()
+
+    def comprobar_carga(self):
+        if self.carga is None:
+            return
+        self.progreso["value"] = self.carga.progress * 100
+        if not self.carga.done():
+            self.ventana.after(30, self.comprobar_carga)
+            return
+
+        carga, self.carga = self.carga, None
+        carga.shutdown()
+        self.mostrar_pantalla_principal()
+        if carga.error() is not None:
+            tk.messagebox.showerror("Error", f"No se han podido cargar los modelos: {carga.error()}")
+            return
+        # solo se redibuja lo que cambia: una sala parada no gasta CPU ni GPU
+        self.engine = GraphicsEngine(self.models_data, win_size=(1600, 900), ward=self.ward,
+                                     prefetched=carga.prefetched, launch_time=self.inicio_carga, dirty=True)
+        self.engine.run()
+
+    def cancelar_carga(self):
+        if self.carga is not None:
+            self.carga.cancel()
+            self.carga = None
+        # los procesos del cargador siguen vivos para la próxima carga
+        self.mostrar_pantalla_principal()
+
+    def salir(self):
+        if self.engine is not None and not self.engine.closed:
+            self.engine.close()
+        if self.carga is not None:
+            self.carga.cancel()
+            self.carga = None
+        AssetLoader.close()
+        self.ventana.destroy()
 
     def run(self):
         self.ventana.mainloop()
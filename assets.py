@@ -0,0 +1,45 @@
+class AssetRegistry:
+    # shared programs, textures, buffers and mesh arrays keyed by name/path,
+    # every Heart acquires what it needs and releases it on destroy
+    def __init__(self, ctx, prefetched=None, retain=False):
+        self.ctx = ctx
+        self.assets = {}  # key -> [asset, refcount]
+        # retain: keep unreferenced assets until purge()/destroy() so a later scene reuses them
+        self.retain = retain
+        # CPU-side data loaded in the background (see loader.py), used instead of the loader
+        self.prefetched = prefetched if prefetched is not None else {}
+        # last state written to GL state the hearts share (bound texture, uniforms of a
+        # shared program), so a heart skips the writes when nothing changed since its own
+        self.sent = {}
+
+    def acquire(self, key, loader):
+        entry = self.assets.get(key)
+        if entry is None:
+            asset = self.prefetched.pop(key) if key in self.prefetched else loader()
+            entry = self.assets[key] = [asset, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, key):
+        entry = self.assets[key]
+        entry[1] -= 1
+        if entry[1] == 0 and not self.retain:
+            del self.assets[key]
+            self.free(entry[0])
+
+    def purge(self):
+        # free the retained assets nobody uses anymore
+        self.sent.clear()
+        for key in [key for key, (_, refcount) in self.assets.items() if refcount == 0]:
+            self.free(self.assets.pop(key)[0])
+
+    def free(self, asset):
+        # moderngl objects own GPU memory, numpy arrays are left to the gc
+        if hasattr(asset, 'release'):
+            asset.release()
+
+    def destroy(self):
+        for asset, _ in self.assets.values():
+            self.free(asset)
+        self.assets.clear()
+        self.sent.clear()
@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from compositor import PaneCompositor
+from headless import HeadlessEngine
+from mesh_cache import load_mesh, parse_obj
+from model import Heart
+from morph import MorphBatch
+from partition import ATLAS_PATH, REGION_TEXTURES, PartitionedHeart
+from picking import HeartPicker, PickMesh, TriangleBVH
+from texture_cache import decode_texture, load_atlas, load_texture
+from ward import ward_layout
+import ecg
+import rhythm
+
+# a metric is a regression when it gets this much slower than the baseline, and by at least
+# MIN_DELTA ms: below that the difference is timer noise
+TOLERANCE = 0.2
+MIN_DELTA = 0.05
+
+
+def measure(fn, repeat):
+    # best and mean wall time of fn in milliseconds
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'min_ms': min(times), 'mean_ms': sum(times) / len(times)}
+
+
+def get_patients(count, seed):
+    # count hearts laid out like the ward view, with the launcher's rhythms
+    positions, scale = ward_layout(count)
+    rhythms = ['Normal', 'Taquicardia', 'Bradicardia', 'Arritmia']
+    ppm, masks = rhythm.generate([rhythms[i % len(rhythms)] for i in range(count)], seed=seed)
+    return [[pos, (0, 0, 0), scale, int(p), mask] for pos, p, mask in zip(positions, ppm, masks)]
+
+
+def bench_loading(engine, repeat):
+    heart = engine.scene.objects[0]
+    results = {}
+    for path in ['objects/heart/base.obj', 'objects/heart/updated_abaix.obj']:
+        results[f'load.parse_obj[{path}]'] = measure(lambda: parse_obj(path), repeat)
+        results[f'load.get_vertex_data[{path}]'] = measure(lambda: np.asarray(load_mesh(path)).sum(), repeat)
+    # decoding the PNG is what a texture cache miss costs, reading the cached image a hit
+    path = 'objects/heart/texture_diffuse.png'
+    results['load.decode_texture'] = measure(lambda: decode_texture(path), repeat)
+    results['load.load_texture'] = measure(lambda: np.asarray(load_texture(path)).sum(), repeat)
+    results['load.load_atlas'] = measure(lambda: np.asarray(load_atlas(REGION_TEXTURES, ATLAS_PATH)).sum(), repeat)
+    results['load.get_texture'] = measure(lambda: heart.get_texture(path).release(), repeat)
+    # the partitioned heart's texture, with the atlas already read
+    results['load.get_texture[atlas]'] = measure(lambda: PartitionedHeart.get_texture(heart, ATLAS_PATH).release(), repeat)
+    results['load.get_program'] = measure(lambda: heart.get_program('default').release(), repeat)
+    return results
+
+
+def bench_picking(engine, repeat, rays=1024, seed=0):
+    # building the hierarchy, refitting it to a morphed heart and tracing rays through it,
+    # against testing every triangle
+    mesh = PickMesh()
+    positions = mesh.positions((0.3, 0.2, 0.1))
+    bvh = TriangleBVH(mesh.base, mesh.triangles)
+    bvh.refit(positions)
+    rng = np.random.default_rng(seed)
+    origins = rng.normal(size=(rays, 3)) * 3
+    directions = rng.normal(size=(rays, 3)) * 0.4 + positions.mean(axis=0) - origins
+    # every triangle in one leaf: the brute force test
+    flat = TriangleBVH.__new__(TriangleBVH)
+    flat.depth, flat.order, flat.triangles = 0, np.arange(len(mesh.triangles)), mesh.triangles
+    flat.leaf_starts, flat.leaf_counts = np.array([0]), np.array([len(mesh.triangles)])
+    flat.refit(positions)
+    picker = HeartPicker(engine)
+    width, height = engine.WIN_SIZE
+    picker.pick((width // 2, height // 2), engine.alpha)  # builds the hierarchy
+    results = {
+        'pick.build': measure(lambda: TriangleBVH(mesh.base, mesh.triangles), repeat),
+        'pick.refit': measure(lambda: bvh.refit(positions), repeat),
+        'pick.query[rays=1]': measure(lambda: bvh.intersect(origins[:1], directions[:1]), repeat),
+        f'pick.query[rays={rays}]': measure(lambda: bvh.intersect(origins, directions), repeat),
+        'pick.brute_force[rays=1]': measure(lambda: flat.intersect(origins[:1], directions[:1]), repeat),
+        # a click on the window: ray from the camera, refit if the heart moved, every heart
+        'pick.pixel': measure(lambda: picker.pick((width // 2, height // 2), engine.alpha), repeat),
+    }
+    return results
+
+
+def bench_rhythm(repeat, seed):
+    # batched masks for a large population and the lazy per-beat stream
+    kinds = list(rhythm.RHYTHMS) * 1000
+    stream = rhythm.stream('Arritmia', seed)
+    return {
+        f'rhythm.generate[patients={len(kinds)}]': measure(lambda: rhythm.generate(kinds, seed=seed), repeat),
+        'rhythm.stream[beats=10000]': measure(lambda: [next(stream) for _ in range(10000)], repeat),
+    }
+
+
+def bench_ecg(repeat, seed, hours=1):
+    # R-peak detection over a synthetic recording read back from disk
+    samples, _ = ecg.synthetic_ecg(hours * 3600, seed=seed)
+    with tempfile.NamedTemporaryFile(suffix='.dat', delete=False) as file:
+        samples.tofile(file)
+    try:
+        results = measure(lambda: ecg.detect(file.name), repeat)
+        results['samples_per_s'] = len(samples) / results['min_ms'] * 1000
+        tracemalloc.start()
+        ecg.detect(file.name)
+        results['alloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        os.remove(file.name)
+    return {f'ecg.detect[hours={hours}]': results}
+
+
+def bench_update(engine, frames):
+    # Heart.update_vertex per heart (and the batched CPU blend), with the temporary memory
+    # numpy allocates in it
+    results = {}
+    batches = {heart.batch for heart in engine.scene.objects if heart.morph == 'cpu'}
+
+    def update():
+        for heart in engine.scene.objects:
+            heart.update_vertex()
+        for batch in batches:
+            batch.flush()
+
+    update()  # warm up lazily built state
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(frames):
+        update()
+    elapsed = (time.perf_counter() - start) * 1000
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # tracing slows the loop down, time it again untraced
+    uploaded = sum(heart.uploaded_bytes for heart in engine.scene.objects)
+    start = time.perf_counter()
+    for _ in range(frames):
+        update()
+    calls = frames * len(engine.scene.objects)
+    results['mean_ms'] = (time.perf_counter() - start) * 1000 / calls
+    results['upload_bytes'] = (sum(heart.uploaded_bytes for heart in engine.scene.objects) - uploaded) / calls
+    results['traced_mean_ms'] = elapsed / calls
+    results['alloc_peak_bytes'] = peak
+    return results
+
+
+def bench_memory(engine):
+    # GPU vertex memory per heart (buffers shared by the hearts counted once) and the
+    # vertex bytes a draw of one heart reads
+    hearts = engine.scene.objects
+    buffers = {id(buffer): buffer.size for heart in hearts for buffer in heart.buffers}
+    return {'vertex_bytes_per_heart': sum(buffers.values()) / len(hearts),
+            'vertex_bytes_per_draw': sum(buffer.size for buffer in hearts[0].buffers)}
+
+
+def bench_render(engine, frames, perspectiva):
+    engine.camera.perspectiva = perspectiva
+
+    def frame():
+        engine.render_views()
+        engine.ctx.finish()
+
+    frame()
+    return measure(frame, frames)
+
+
+def bench_idle(engine, frames):
+    # orthographic frames with dirty rendering while nothing moves: only the state checks
+    engine.camera.perspectiva = False
+    engine.render_dirty_views(engine.fbo)
+    results = measure(lambda: engine.render_dirty_views(engine.fbo), frames)
+    engine.view_states.clear()
+    return results
+
+
+def bench_lods(engine, frames, label):
+    # perspective frame time with every heart pinned to each level of detail
+    results = {}
+    hearts = engine.scene.objects
+    for level, ibo in enumerate(hearts[0].lod_ibos):
+        for heart in hearts:
+            heart.fixed_lod = level
+        metrics = bench_render(engine, frames, True)
+        metrics['triangles'] = ibo.size // hearts[0].indices.itemsize // 3
+        results[f'render.lod{level}[{label}]'] = metrics
+    for heart in hearts:
+        heart.fixed_lod = None
+    return results
+
+
+def bench_compositor(models_data, frames, win_size, backend):
+    # frame time of the hearts' perspective (a pane per heart) and 4-view layouts with every
+    # pane drawn by its own process, composited into an offscreen framebuffer
+    engine = HeadlessEngine([], win_size, backend=backend)
+    results = {}
+    for perspectiva, layout in [(True, 'perspective'), (False, 'orthographic')]:
+        compositor = PaneCompositor(engine.ctx, models_data, win_size, perspectiva=perspectiva, backend=backend)
+
+        def frame():
+            compositor.compose(engine.fbo)
+            engine.ctx.finish()
+
+        frame()  # waits for the workers to load
+        results[f'render.compositor.{layout}[hearts={len(models_data)}]'] = measure(frame, frames)
+        compositor.destroy()
+    engine.destroy()
+    return results
+
+
+def run(counts, modes, frames, repeat, win_size, seed, backend, compositor=False):
+    results = {}
+    for count in counts:
+        models_data = get_patients(count, seed)
+        for morph in modes:
+            engine = HeadlessEngine([], win_size, backend=backend)
+            for pos, rot, scale, ppm, mask in models_data:
+                if morph == 'partition':
+                    heart = PartitionedHeart(engine, pos, rot, scale, ppm, mask, assets=engine.scene.assets)
+                elif morph == 'compact':
+                    heart = Heart(engine, pos, rot, scale, ppm, mask, morph='gpu', assets=engine.scene.assets, vertex_format='compact')
+                else:
+                    heart = Heart(engine, pos, rot, scale, ppm, mask, morph=morph, assets=engine.scene.assets, vertex_format='float')
+                engine.scene.add_object(heart)
+            results.setdefault('renderer', engine.ctx.info['GL_RENDERER'])
+            if count == counts[0] and morph == modes[0]:
+                results.update(bench_loading(engine, repeat))
+                results.update(bench_picking(engine, repeat))
+                results.update(bench_rhythm(repeat, seed))
+                results.update(bench_ecg(repeat, seed))
+            results[f'update[{morph}, hearts={count}]'] = bench_update(engine, frames)
+            results[f'memory[{morph}, hearts={count}]'] = bench_memory(engine)
+            results[f'render.perspective[{morph}, hearts={count}]'] = bench_render(engine, frames, True)
+            results[f'render.orthographic[{morph}, hearts={count}]'] = bench_render(engine, frames, False)
+            results[f'render.idle[{morph}, hearts={count}]'] = bench_idle(engine, frames)
+            if morph == modes[0]:
+                results.update(bench_lods(engine, frames, f'{morph}, hearts={count}'))
+            engine.destroy()
+        if compositor:
+            results.update(bench_compositor(models_data, frames, win_size, backend))
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, min_delta=MIN_DELTA):
+    # metrics slower than the baseline by more than tolerance and min_delta ms (timings only)
+    regressions = []
+    for name, metrics in results.items():
+        reference = baseline.get('results', {}).get(name)
+        if not reference:
+            continue
+        key = 'min_ms' if 'min_ms' in metrics else 'mean_ms'
+        if reference.get(key) and metrics[key] > max(reference[key] * (1 + tolerance), reference[key] + min_delta):
+            regressions.append((name, reference[key], metrics[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark mesh/texture loading, picking, rhythm generation, ECG R-peak detection, morph updates and rendering')
+    parser.add_argument('--hearts', default='1,2,4,8', help='comma separated heart counts')
+    parser.add_argument('--modes', default='gpu,compact,cpu,baked,partition',
+                        help="comma separated morph modes ('partition': PartitionedHeart, 'compact': gpu with quantize.py vertices)")
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=10, help='repetitions of each loading step')
+    parser.add_argument('--size', default='800x450', help='framebuffer size WxH')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default='egl')
+    parser.add_argument('--morph-workers', type=int, default=MorphBatch.workers, help='threads of the batched CPU morph')
+    parser.add_argument('--compositor', action='store_true', help='also time the layouts drawn by a process per pane (compositor.py)')
+    parser.add_argument('--out', help='write the JSON results to this file (default stdout)')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--min-delta', type=float, default=MIN_DELTA, help='ms a metric must get slower by to count as a regression')
+    args = parser.parse_args()
+
+    win_size = tuple(int(n) for n in args.size.split('x'))
+    counts = [int(n) for n in args.hearts.split(',')]
+    modes = args.modes.split(',')
+    MorphBatch.workers = args.morph_workers
+    results = run(counts, modes, args.frames, args.repeat, win_size, args.seed, args.backend, args.compositor)
+    renderer = results.pop('renderer')
+    report = {
+        'config': vars(args),
+        'system': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                   'renderer': renderer},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance, args.min_delta)
+        for name, before, after in regressions:
+            print(f'REGRESSION {name}: {before:.3f} ms -> {after:.3f} ms', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
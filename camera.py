@@ -1,4 +1,5 @@
 import glm
+import numpy as np
 import pygame as pg
 
 FOV = 50  # deg
@@ -7,6 +8,25 @@ FAR = 100
 SPEED = 0.005
 SENSITIVITY = 0.04
 
+# uniform block shared by every heart program (std140: mat4 m_proj, mat4 m_view, vec3 camPos)
+CAMERA_BLOCK = 'Camera'
+CAMERA_BINDING = 0
+CAMERA_BLOCK_SIZE = 144
+
+PERSPECTIVE_VIEW = ((0, -2, -6), (0, 1, 0), (0, 0, -1))
+# vistes ortogonals: name -> (cell of the 2x2 viewport grid (column, row from the bottom),
+# (position, up, forward) with one heart, with several)
+ORTHO_VIEWS = {
+    'alzado': ((0, 1), ((0, -2, -7.5), (0, 1, 0), (0, 0, -1)),
+                       ((0, -2, -7), (0, 1, 0), (0, 0, -1))),
+    'perfil': ((0, 0), ((-2.5, -2, -10), (0, 1, 0), (1, 0, 0)),
+                       ((-3.5, -2, -10), (0, 1, 0), (1, 0, 0))),
+    'axonometrica': ((1, 0), ((-1.5, -2, -8), (0, 1, 0), tuple(glm.normalize(glm.vec3(0, -2, -10) - glm.vec3(-1.5, -2, -8)))),
+                             ((-1.5, -2, -7), (0, 1, 0), tuple(glm.normalize(glm.vec3(0, -2, -10) - glm.vec3(-1.5, -2, -7))))),
+    'planta': ((1, 1), ((0, 0.5, -10), (0, 0, -1), (0, -1, 0)),
+                       ((0, 1.5, -10), (0, 0, -1), (0, -1, 0))),
+}
+
 
 class Camera:
     def __init__(self, app, position=(0, -2, -6), up=(0, 1, 0), forward=(0, 0, -1)):
@@ -24,13 +44,49 @@ class Camera:
         # guardar la posició del zoom
         self.zoom = glm.vec3((0,0,0))
         self.right = glm.vec3((1, 0, 0))
+        # one block per view in the uniform buffer, each rewritten only when its matrices
+        # change (the zoom); the projection is the perspective one for every view
+        ctx = app.ctx
+        alignment = ctx.info['GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT']
+        self.block_stride = -(-CAMERA_BLOCK_SIZE // alignment) * alignment
+        self.ubo = ctx.buffer(reserve=self.block_stride * (1 + 2 * len(ORTHO_VIEWS)))
+        self.views = {}  # (position, up, forward) -> [offset, zoom, view matrix]
 
     def update(self, position, up, forward):
+        # make the view the current one, its matrices are only computed on the first use
+        # and when the zoom moves it
+        view = self.views.get((position, up, forward))
+        if view is None:
+            if (len(self.views) + 1) * self.block_stride > self.ubo.size:
+                # more views than reserved, start over in a larger buffer
+                self.ubo.orphan(self.ubo.size * 2)
+                self.views.clear()
+            view = self.views[(position, up, forward)] = [len(self.views) * self.block_stride, None, None]
         self.position = glm.vec3(position) + self.zoom
         self.up = glm.vec3(up)
         self.forward = glm.vec3(forward)
-        self.m_view = self.get_view_matrix()
-        self.m_proj = self.get_projection_matrix()
+        if view[1] != self.zoom:
+            view[1] = glm.vec3(self.zoom)
+            view[2] = self.get_view_matrix()
+            block = np.zeros(CAMERA_BLOCK_SIZE // 4, dtype='f4')
+            # column-major, as glm stores them
+            block[:16] = np.frombuffer(self.m_proj.to_bytes(), dtype='f4')
+            block[16:32] = np.frombuffer(view[2].to_bytes(), dtype='f4')
+            block[32:35] = self.position
+            self.ubo.write(block, offset=view[0])
+        self.m_view = view[2]
+        self.ubo.bind_to_uniform_block(CAMERA_BINDING, offset=view[0], size=CAMERA_BLOCK_SIZE)
+
+    def get_ray(self, view, x, y):
+        # world space (origin, direction) through the normalized device coordinates (x, y)
+        # of a view, from the near plane (t = 0) to the far plane (t = 1)
+        position, up, forward = view
+        position = glm.vec3(position) + self.zoom
+        m_view = glm.lookAt(position, position + glm.vec3(forward), glm.vec3(up))
+        inverse = glm.inverse(self.m_proj * m_view)
+        near, far = inverse * glm.vec4(x, y, -1.0, 1.0), inverse * glm.vec4(x, y, 1.0, 1.0)
+        near, far = glm.vec3(near) / near.w, glm.vec3(far) / far.w
+        return near, far - near
 
     def move(self):
         velocity = SPEED * self.app.delta_time
@@ -59,22 +115,5 @@ class Camera:
         else:
             return glm.ortho(-5, 5, -5, 1, NEAR, FAR)
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    def destroy(self):
+        self.ubo.release()
@@ -0,0 +1,84 @@
+import argparse
+import numpy as np
+
+# the heart animation advances a fixed step per update: SIMULATION_RATE updates per second
+# of simulated time, however many frames are drawn in it
+SIMULATION_RATE = 60
+# steps a single frame may catch up (a quarter of a second); a longer stall (window
+# dragged, debugger) is dropped instead of replayed all at once
+MAX_STEPS = 15
+
+
+class SimulationClock:
+    # fixed-step accumulator fed with the frame times: advance() gives the steps to run for
+    # a frame and alpha, how far the frame is between the last two steps, to interpolate
+    def __init__(self, rate=SIMULATION_RATE, max_steps=MAX_STEPS):
+        self.step_time = 1000 / rate  # ms
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.steps = 0  # run so far
+        self.dropped = 0  # skipped by the catch-up limit
+
+    def advance(self, delta_time):
+        # steps due after delta_time more ms
+        self.accumulator += delta_time
+        steps = int(self.accumulator // self.step_time)
+        self.accumulator -= steps * self.step_time
+        if steps > self.max_steps:
+            self.dropped += steps - self.max_steps
+            steps = self.max_steps
+        self.steps += steps
+        self.alpha = self.accumulator / self.step_time
+        return steps
+
+    def get_time(self):
+        # seconds of simulated time
+        return self.steps * self.step_time * 0.001
+
+
+def frame_times(fps, count, jitter=0.2, drops=0.01, seed=None):
+    # ms per frame of a renderer aiming at fps: +-jitter around the frame time and a
+    # fraction of frames taking three frame times
+    rng = np.random.default_rng(seed)
+    times = 1000 / fps * (1 + rng.uniform(-jitter, jitter, count))
+    times[rng.random(count) < drops] *= 3
+    return times
+
+
+def measure_bpm(ppm, fps, minutes=10, seed=None):
+    # beats per minute of wall time a heart beating at ppm shows when drawn at fps with
+    # uneven frame times, (on the clock, stepping once per frame like before the clock)
+    from model import Heart
+    heart = Heart.__new__(Heart)  # only its animation state, no GL
+    heart.ppm = ppm
+    heart.set_beat_mask([1.0])
+    heart.animation_progress_1 = heart.animation_progress_2 = heart.animation_progress_3 = 0.0
+    heart.beat_count = 0
+    times = frame_times(fps, int(minutes * 60 * fps), seed=seed)
+    clock = SimulationClock()
+    for delta_time in times:
+        for _ in range(clock.advance(delta_time)):
+            heart.update_progress()
+    # whole beats and the part of the current one
+    clocked = heart.beat_count + heart.animation_progress_1
+    # per frame: one step whatever the frame took
+    heart.animation_progress_1, heart.beat_count = 0.0, 0
+    for _ in range(len(times)):
+        heart.update_progress()
+    wall = times.sum() / 60000
+    return clocked / wall, (heart.beat_count + heart.animation_progress_1) / wall, clock.dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Beats per minute shown for each ppm and frame rate, on the simulation clock and stepping once per frame')
+    parser.add_argument('--ppm', default='30,60,72,100,160')
+    parser.add_argument('--fps', default='24,60,144')
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for fps in [int(f) for f in args.fps.split(',')]:
+        for ppm in [int(p) for p in args.ppm.split(',')]:
+            clocked, per_frame, dropped = measure_bpm(ppm, fps, args.minutes, args.seed)
+            print(f'{fps} fps, {ppm} ppm: {clocked:.2f} bpm on the clock ({dropped} steps dropped), {per_frame:.2f} bpm per frame')
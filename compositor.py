@@ -0,0 +1,237 @@
+import argparse
+import queue
+import time
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import moderngl as mgl
+import numpy as np
+import pygame as pg
+from camera import ORTHO_VIEWS
+from headless import HeadlessEngine, get_models_data
+from main import CLEAR_COLOR
+from profiler import FrameProfiler, ProfilerHud
+
+# comparison and 4-view layouts split into panes, each simulated and drawn offscreen by its
+# own worker process (own interpreter, own GL context) into a ring of frames in shared
+# memory; the window only uploads each pane's next frame into a texture and draws it over
+# the pane's viewport
+
+# frames of a pane's ring: the worker draws up to this many frames ahead of the window
+RING_SLOTS = 3
+# the heart of a comparison pane, where a lone heart is drawn
+PANE_POSITION = (0, -2, -10)
+
+
+def pane_layout(models_data, win_size, perspectiva=True):
+    # (models_data, view, viewport) of every pane: in perspective a column per heart, each one
+    # centered in its pane; in orthographic a quarter of the window per view, with every heart
+    if perspectiva:
+        width = win_size[0] // len(models_data)
+        return [([[PANE_POSITION, *data[1:]]], None, (i * width, 0, width, win_size[1]))
+                for i, data in enumerate(models_data)]
+    width, height = win_size[0] // 2, win_size[1] // 2
+    return [(models_data, name, (column * width, row * height, width, height))
+            for name, ((column, row), *_) in ORTHO_VIEWS.items()]
+
+
+class PaneEngine(HeadlessEngine):
+    # one pane: the whole framebuffer is one view of the layout (None: perspective)
+    def __init__(self, models_data, win_size, view=None, **kwargs):
+        super().__init__(models_data, win_size, **kwargs)
+        self.view = view
+        self.camera.perspectiva = view is None
+
+    def get_views(self):
+        if self.view is None:
+            return super().get_views()
+        _, *views = ORTHO_VIEWS[self.view]
+        return [(self.view, (0, 0, *self.WIN_SIZE), views[len(self.scene.objects) > 1])]
+
+
+def render_pane(models_data, view, size, fps, name, slots, free, ready, stop, backend='egl', partitioned=False):
+    # worker: frames 0, 1, 2... of the pane at fps, each one read straight from the
+    # framebuffer into the next free slot of the ring, then its (frame, slot) sent as ready
+    memory = SharedMemory(name)
+    ready.cancel_join_thread()
+    engine = PaneEngine(models_data, size, view, backend=backend, partitioned=partitioned, dirty=True)
+    frame_size = size[0] * size[1] * 3
+    frame = 0
+    try:
+        while not stop.is_set():
+            if not free.acquire(timeout=0.1):
+                continue
+            slot = frame % slots
+            engine.seek(frame, fps)
+            engine.render_dirty_views(engine.fbo)
+            engine.fbo.read_into(memory.buf, components=3, write_offset=slot * frame_size)
+            ready.put((frame, slot))
+            frame += 1
+    finally:
+        engine.destroy()
+        memory.close()
+
+
+class Pane:
+    # the window's side of a worker: its ring, the texture the frames go to and the process
+    def __init__(self, context, ctx, models_data, view, viewport, fps, slots, **kwargs):
+        self.viewport = viewport
+        size = viewport[2:]
+        frame_size = size[0] * size[1] * 3
+        self.memory = SharedMemory(create=True, size=slots * frame_size)
+        # one view per slot into the shared block, handed to the texture upload as is
+        self.slots = [self.memory.buf[i * frame_size:(i + 1) * frame_size] for i in range(slots)]
+        self.free = context.Semaphore(slots)
+        self.ready = context.Queue()
+        self.stop = context.Event()
+        self.texture = ctx.texture(size, 3)
+        self.texture.filter = (mgl.NEAREST, mgl.NEAREST)
+        self.process = context.Process(target=render_pane, daemon=True, kwargs=dict(
+            models_data=models_data, view=view, size=size, fps=fps, name=self.memory.name, slots=slots,
+            free=self.free, ready=self.ready, stop=self.stop, **kwargs))
+        self.process.start()
+        self.frame = -1
+
+    def upload(self):
+        # wait for the pane's next frame and copy it from its slot into the texture
+        while True:
+            try:
+                self.frame, slot = self.ready.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f'pane worker exited with code {self.process.exitcode}')
+        self.texture.write(self.slots[slot])
+        # the upload copied it, the worker can draw over the slot
+        self.free.release()
+
+    def destroy(self):
+        self.stop.set()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.ready.close()
+        for view in self.slots:
+            view.release()
+        self.memory.close()
+        self.memory.unlink()
+        self.texture.release()
+
+
+class PaneCompositor:
+    # the panes of a layout and the quad that draws each pane's texture over its viewport
+    def __init__(self, ctx, models_data, win_size, fps=30, perspectiva=True, slots=RING_SLOTS, profiler=None,
+                 **kwargs):
+        self.ctx = ctx
+        self.win_size = win_size
+        self.profiler = profiler or FrameProfiler(ctx)
+        with open('shaders/hud.vert') as file:
+            vertex_shader = file.read()
+        with open('shaders/hud.frag') as file:
+            fragment_shader = file.read()
+        self.program = ctx.program(vertex_shader=vertex_shader, fragment_shader=fragment_shader)
+        self.program['u_texture_0'] = 0
+        self.program['u_rect'] = (-1, -1, 2, 2)
+        quad = np.array([0, 0, 1, 0, 0, 1, 1, 1], dtype='f4')
+        self.vbo = ctx.buffer(quad)
+        self.vao = ctx.vertex_array(self.program, [(self.vbo, '2f', 'in_position')])
+        # GL contexts do not survive a fork, every worker starts a fresh interpreter
+        context = get_context('spawn')
+        self.panes = [Pane(context, ctx, data, view, viewport, fps, slots, **kwargs)
+                      for data, view, viewport in pane_layout(models_data, win_size, perspectiva)]
+        self.frame = -1
+
+    def compose(self, target):
+        # the next frame of every pane, all of the same frame, drawn into target
+        with self.profiler.stage('wait panes'):
+            for pane in self.panes:
+                pane.upload()
+        self.frame = self.panes[0].frame
+        with self.profiler.stage('composite'):
+            target.use()
+            self.ctx.viewport = (0, 0, *self.win_size)
+            target.clear(*CLEAR_COLOR)
+            self.ctx.disable(mgl.DEPTH_TEST | mgl.CULL_FACE)
+            for pane in self.panes:
+                self.ctx.viewport = pane.viewport
+                pane.texture.use(location=0)
+                self.vao.render(mgl.TRIANGLE_STRIP)
+            self.ctx.enable(mgl.DEPTH_TEST | mgl.CULL_FACE)
+        return self.frame
+
+    def destroy(self):
+        for pane in self.panes:
+            pane.destroy()
+        self.vao.release()
+        self.vbo.release()
+        self.program.release()
+
+
+class CompositorEngine:
+    # window showing a PaneCompositor at fps (ESC or closing it ends, F3 profiler)
+    def __init__(self, models_data, win_size=(1600, 900), fps=30, perspectiva=True, **kwargs):
+        pg.init()
+        self.WIN_SIZE = win_size
+        pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 3)
+        pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
+        pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
+        pg.display.set_mode(self.WIN_SIZE, flags=pg.OPENGL | pg.DOUBLEBUF)
+        self.ctx = mgl.create_context()
+        self.clock = pg.time.Clock()
+        self.fps = fps
+        self.profiler = FrameProfiler(self.ctx)
+        self.hud = ProfilerHud(self, self.profiler)
+        self.compositor = PaneCompositor(self.ctx, models_data, win_size, fps, perspectiva, profiler=self.profiler,
+                                         **kwargs)
+        self.running = False
+
+    def check_events(self):
+        for event in pg.event.get():
+            if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                self.running = False
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                self.hud.toggle()
+
+    def run(self):
+        # the frames are the ones an export at fps would write: when the workers fall
+        # behind the window waits for them, the hearts slow down but the panes stay in step
+        self.running = True
+        start = time.perf_counter()
+        while self.running:
+            self.profiler.begin_frame()
+            self.check_events()
+            self.compositor.compose(self.ctx.screen)
+            self.hud.render()
+            with self.profiler.stage('flip'):
+                pg.display.flip()
+            with self.profiler.stage('tick'):
+                self.clock.tick(self.fps)
+            self.profiler.end_frame()
+        frames, elapsed = self.compositor.frame + 1, time.perf_counter() - start
+        print(f'{frames} frames in {elapsed:.1f} s ({frames / elapsed:.1f} fps)')
+
+    def destroy(self):
+        self.compositor.destroy()
+        self.hud.destroy()
+        self.profiler.destroy()
+        pg.quit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show a comparison or 4-view layout with every pane simulated and drawn by its own process')
+    parser.add_argument('rhythm', help='Normal, Taquicardia, Bradicardia, Arritmia, Fibrilacion, Extrasistole or "A vs B"')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--size', default='1600x900', help='window size WxH')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the generated rhythm')
+    parser.add_argument('--ortho', action='store_true', help='4-view orthographic layout, a process per view')
+    parser.add_argument('--slots', type=int, default=RING_SLOTS, help='frames each pane may draw ahead of the window')
+    parser.add_argument('--backend', default='egl', help="moderngl standalone backend of the workers, '' for the platform default")
+    parser.add_argument('--partitioned', action='store_true', help='draw the heart as its separate regions')
+    args = parser.parse_args()
+
+    win_size = tuple(int(n) for n in args.size.split('x'))
+    engine = CompositorEngine(get_models_data(args.rhythm, args.seed), win_size, args.fps, not args.ortho,
+                              slots=args.slots, backend=args.backend, partitioned=args.partitioned)
+    try:
+        engine.run()
+    finally:
+        engine.destroy()
@@ -0,0 +1,235 @@
+import argparse
+import io
+import mmap
+import time
+from collections import deque
+import numpy as np
+from clock import SIMULATION_RATE
+
+# recorded ECG traces replayed as the heart's rhythm: a chunked reader over a memory-mapped
+# file (raw int16 samples or CSV), a streaming R-peak detector and a playback clock that
+# wraps the heart's cycle on every R-peak it reaches, at the rate that brings the next wrap
+# onto the next R-peak (Heart.update_animation_params(ppm, [amplitude])).
+# Only one chunk of samples is in memory at a time, whatever the length of the recording
+
+ECG_RATE = 360  # samples per second (MIT-BIH)
+CHUNK_SAMPLES = 1 << 16
+PPM_RANGE = (20, 250)
+# seconds decoded ahead of playback: an R-peak is confirmed ~0.2 s after it, so the next
+# one is known when the current one is reached even at the slowest rate
+LOOKAHEAD = 60 / PPM_RANGE[0] + 0.5
+
+
+def release_pages(mm, start, end):
+    # drop the already read pages of the mapping so they do not pile up in memory
+    start -= start % mmap.PAGESIZE
+    end -= end % mmap.PAGESIZE
+    if end > start:
+        mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def read_raw_chunks(mm, chunk, dtype, channels, channel):
+    dtype = np.dtype(dtype)
+    frame = dtype.itemsize * channels
+    frames = len(mm) // frame
+    for first in range(0, frames, chunk):
+        count = min(chunk, frames - first)
+        view = np.frombuffer(mm, dtype, count * channels, first * frame)
+        samples = view[channel::channels].astype('f4')
+        del view
+        release_pages(mm, first * frame, (first + count) * frame)
+        yield samples
+
+
+def read_csv_chunks(mm, chunk, column, delimiter):
+    # blocks of about chunk lines, always cut at a line end; a first line that is not a
+    # number is taken as a header
+    size = len(mm)
+    newline = mm.find(b'\n')
+    start = 0
+    try:
+        float(mm[:size if newline < 0 else newline].split(delimiter.encode())[column])
+    except (ValueError, IndexError):
+        start = size if newline < 0 else newline + 1
+    # the first data line gives the bytes per line
+    newline = mm.find(b'\n', start)
+    line_size = max(1, (size if newline < 0 else newline + 1) - start)
+    while start < size:
+        end = mm.find(b'\n', min(start + chunk * line_size, size) - 1)
+        end = size if end < 0 else end + 1
+        block = mm[start:end]
+        if block.strip():
+            yield np.loadtxt(io.BytesIO(block), delimiter=delimiter, usecols=column, dtype='f4', ndmin=1)
+        release_pages(mm, start, end)
+        start = end
+
+
+def read_chunks(path, chunk=CHUNK_SAMPLES, dtype='<i2', channels=1, channel=0, delimiter=','):
+    # float32 samples of one lead of the recording, chunk samples at a time; .csv/.txt
+    # files are text (channel is the column), anything else is raw interleaved dtype samples
+    with open(path, 'rb') as file:
+        if not file.seek(0, 2):
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if path.lower().endswith(('.csv', '.txt')):
+                yield from read_csv_chunks(mm, chunk, channel, delimiter)
+            else:
+                yield from read_raw_chunks(mm, chunk, dtype, channels, channel)
+
+
+class RPeakDetector:
+    # streaming Pan-Tompkins: five point derivative, squaring, 150 ms moving window
+    # integration and an adaptive threshold between the signal and noise peak levels.
+    # feed() takes consecutive chunks of any size, the state between them is a few samples
+    def __init__(self, rate=ECG_RATE):
+        self.rate = rate
+        self.window = max(1, round(0.15 * rate))
+        self.refractory = round(0.2 * rate)
+        self.history = np.zeros(self.window + 4)  # raw samples before the current chunk
+        self.integrated = np.zeros(2)  # integrated samples not checked as peaks yet
+        self.position = 0  # index of the next sample in the recording
+        self.signal_level = self.noise_level = None
+        self.learning = []  # the first 2 seconds, held back until they are all in
+        self.last_peak = -self.refractory
+
+    def feed(self, samples):
+        # (sample index of each R-peak, its QRS peak to peak height) found in the chunk
+        samples = np.asarray(samples, dtype='f8')
+        if self.signal_level is None:
+            self.learning.append(samples)
+            if sum(len(chunk) for chunk in self.learning) < 2 * self.rate:
+                return np.empty(0, dtype=int), np.empty(0)
+            samples, self.learning = np.concatenate(self.learning), None
+        size, past, window = len(samples), len(self.history), self.window
+        if not size:
+            return np.empty(0, dtype=int), np.empty(0)
+        raw = np.concatenate([self.history, samples])
+        slope = (2 * raw[4:] + raw[3:-1] - raw[1:-3] - 2 * raw[:-4]) / 8  # slope[k] ends at raw[k + 4]
+        energy = np.concatenate([[0.0], np.cumsum(slope * slope)])
+        last = np.arange(past - 4, past - 4 + size)  # newest slope of each new sample
+        integrated = np.concatenate([self.integrated, (energy[last + 1] - energy[last + 1 - window]) / window])
+        self.history = raw[-past:]
+        self.integrated = integrated[-2:]
+
+        if self.signal_level is None:
+            # learning phase on the first 2 seconds
+            learn = integrated[:2 * self.rate]
+            self.signal_level, self.noise_level = learn.max() * 0.5, learn.mean() * 0.5
+
+        # integrated[j] is sample position - 2 + j, raw[i] is position - past + i
+        maxima = np.flatnonzero((integrated[1:-1] > integrated[:-2]) & (integrated[1:-1] >= integrated[2:])) + 1
+        indices, heights = [], []
+        for j in maxima.tolist():
+            value, index = integrated[j], self.position - 2 + j
+            threshold = self.noise_level + 0.25 * (self.signal_level - self.noise_level)
+            if value > threshold and index - self.last_peak > self.refractory:
+                self.signal_level = 0.125 * value + 0.875 * self.signal_level
+                self.last_peak = index
+                # the QRS lies in the integration window that ends at the peak
+                end = j - 2 + past + 1
+                qrs = raw[max(0, end - window - 4):end]
+                indices.append(index - (len(qrs) - 1 - int(qrs.argmax())))
+                heights.append(float(qrs.max() - qrs.min()))
+            else:
+                self.noise_level = 0.125 * value + 0.875 * self.noise_level
+        self.position += size
+        return np.array(indices, dtype=int), np.array(heights)
+
+
+class EcgPlayback:
+    # replays a recording on the heart: each R-peak that playback reaches starts a beat,
+    # with the rate of the R-R interval to the next peak and the beat strength from the R
+    # height relative to the running average
+    def __init__(self, path, rate=ECG_RATE, chunk=CHUNK_SAMPLES, **reader_args):
+        self.rate = rate
+        self.chunks = read_chunks(path, chunk, **reader_args)
+        self.detector = RPeakDetector(rate)
+        self.beats = deque()  # (time, height) detected but not reached yet
+        self.time = 0.0
+        self.decoded = 0.0  # seconds of recording run through the detector
+        self.finished = False
+        self.last_beat = None
+        self.height = None
+
+    def decode(self):
+        samples = next(self.chunks, None)
+        if samples is None:
+            self.finished = True
+            return
+        indices, heights = self.detector.feed(samples)
+        self.beats.extend(zip((indices / self.rate).tolist(), heights.tolist()))
+        self.decoded += len(samples) / self.rate
+
+    def advance(self, heart, dt=1 / SIMULATION_RATE):
+        self.time += dt
+        while not self.finished and self.decoded < self.time + LOOKAHEAD:
+            self.decode()
+        while self.beats and self.beats[0][0] <= self.time:
+            beat, height = self.beats.popleft()
+            self.height = height if self.height is None else 0.875 * self.height + 0.125 * height
+            # the interval to the next peak, at the end of the recording the last one
+            if self.beats and self.beats[0][0] > beat:
+                interval = self.beats[0][0] - beat
+            elif self.last_beat is not None and beat > self.last_beat:
+                interval = beat - self.last_beat
+            else:
+                interval = 60 / heart.ppm
+            ppm = min(max(60 / interval, PPM_RANGE[0]), PPM_RANGE[1])
+            amplitude = min(height / self.height, 1.0) if self.height else 1.0
+            heart.update_animation_params(ppm, [amplitude])
+            # the heart's next step wraps its cycle at the peak, carrying over the
+            # time since it; a cycle that already wrapped (a step early) is only put back
+            phase = (self.time - dt - beat) * ppm / 60
+            if heart.animation_progress_1 >= 0.5:
+                phase += 1.0
+            heart.animation_progress_1 = max(phase, 0.0)
+            self.last_beat = beat
+
+    def close(self):
+        self.chunks.close()
+
+
+def synthetic_ecg(duration, rate=ECG_RATE, ppm=72, variability=0.05, noise=0.02, seed=None):
+    # int16 lead with P, QRS and T waves, baseline wander and noise; returns the samples
+    # and the sample index of every R-peak
+    rng = np.random.default_rng(seed)
+    intervals = 60 / ppm * (1 + rng.uniform(-variability, variability, int(duration * ppm / 60 * 1.2) + 2))
+    peaks = 0.5 + np.cumsum(intervals) - intervals[0]
+    peaks = peaks[peaks < duration - 0.5]
+    t = np.arange(int(duration * rate)) / rate
+    signal = 0.15 * np.sin(2 * np.pi * 0.3 * t) + rng.normal(0, noise, len(t))
+    for offset, width, height in [(-0.2, 0.025, 0.15), (-0.03, 0.008, -0.1), (0.0, 0.01, 1.0),
+                                  (0.03, 0.008, -0.25), (0.25, 0.04, 0.3)]:
+        # each wave only touches the samples within 5 widths of it
+        span = int(5 * width * rate)
+        around = np.rint((peaks + offset) * rate).astype(int)[:, None] + np.arange(-span, span + 1)
+        around = around[(around >= 0).all(axis=1) & (around < len(t)).all(axis=1)]
+        center = around[:, span:span + 1] / rate
+        np.add.at(signal, around, height * np.exp(-0.5 * ((t[around] - center) / width) ** 2))
+    return (signal * 1000).astype('<i2'), np.rint(peaks * rate).astype(int)
+
+
+def detect(path, rate=ECG_RATE, chunk=CHUNK_SAMPLES, **reader_args):
+    # every R-peak of the recording, with the samples per second the detection ran at
+    detector = RPeakDetector(rate)
+    indices, samples = [], 0
+    start = time.perf_counter()
+    for chunk_samples in read_chunks(path, chunk, **reader_args):
+        indices.append(detector.feed(chunk_samples)[0])
+        samples += len(chunk_samples)
+    elapsed = time.perf_counter() - start
+    return np.concatenate(indices) if indices else np.empty(0, dtype=int), samples / elapsed if elapsed else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Detect the R-peaks of an ECG recording (raw int16 or CSV)')
+    parser.add_argument('path')
+    parser.add_argument('--rate', type=int, default=ECG_RATE, help='samples per second')
+    parser.add_argument('--channels', type=int, default=1, help='interleaved leads of a raw file')
+    parser.add_argument('--channel', type=int, default=0, help='lead (raw) or column (CSV) to read')
+    args = parser.parse_args()
+
+    peaks, throughput = detect(args.path, args.rate, channels=args.channels, channel=args.channel)
+    intervals = np.diff(peaks) / args.rate
+    print(f'{len(peaks)} beats, {60 / intervals.mean() if len(intervals) else 0:.1f} ppm mean, '
+          f'{throughput / 1e6:.2f} M samples/s')
@@ -0,0 +1,163 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import moderngl as mgl
+import numpy as np
+import pygame as pg
+from camera import Camera
+from clock import SIMULATION_RATE
+from ecg import ECG_RATE, EcgPlayback
+from light import Light
+from main import GraphicsEngine
+from picking import HeartPicker
+from profiler import FrameProfiler
+from scene import Scene
+
+
+class HeadlessEngine(GraphicsEngine):
+    # same Scene/Heart rendering as GraphicsEngine, into an offscreen framebuffer of a
+    # standalone context (EGL works on GPU-less machines with Mesa's llvmpipe)
+    def __init__(self, models_data, win_size=(1600, 900), ward=False, backend='egl', partitioned=False, dirty=False):
+        self.WIN_SIZE = win_size
+        self.ctx = mgl.create_context(standalone=True, backend=backend) if backend else \
+            mgl.create_context(standalone=True)
+        self.ctx.enable(flags=mgl.DEPTH_TEST | mgl.CULL_FACE)
+        self.fbo = self.ctx.framebuffer(color_attachments=[self.ctx.renderbuffer(win_size)],
+                                        depth_attachment=self.ctx.depth_renderbuffer(win_size))
+        self.fbo.use()
+        # no window, no input
+        self.interactive = False
+        self.time = 0
+        self.delta_time = 1000 / SIMULATION_RATE
+        self.profiler = FrameProfiler(self.ctx)
+        self.light = Light()
+        self.camera = Camera(self)
+        self.scene = Scene(self, models_data, ward, partitioned=partitioned)
+        self.picker = HeartPicker(self)
+        self.picked = None
+        # dirty: frames only redraw the views that changed (see GraphicsEngine.render_dirty_views)
+        self.dirty = dirty
+        self.view_fbo = None
+        self.view_states = {}
+        self.steps = 0  # simulation steps run
+        self.alpha = 1.0  # of the frame the hearts were last animated for
+
+    def step(self, steps=1, alpha=1.0):
+        # advance the simulation without drawing
+        self.scene.animate(steps, alpha)
+        self.alpha = alpha
+        self.steps += steps
+        self.time += steps * self.delta_time * 0.001
+
+    def seek(self, frame, fps):
+        # the hearts at frame of an fps sequence: the steps up to its time and the part of
+        # the last step it is past, exact integer arithmetic so any worker lands on the same state
+        steps = -(-frame * SIMULATION_RATE // fps)
+        alpha = 1.0 - (steps * fps - frame * SIMULATION_RATE) / fps
+        self.step(steps - self.steps, alpha)
+
+    def render_frame(self):
+        # top-down RGB bytes of the current frame
+        self.fbo.use()
+        if self.dirty:
+            self.render_dirty_views(self.fbo)
+        else:
+            self.render_views()
+        data = np.frombuffer(self.fbo.read(components=3), dtype='u1')
+        return data.reshape(self.WIN_SIZE[1], self.WIN_SIZE[0], 3)[::-1].tobytes()
+
+    def destroy(self):
+        self.scene.destroy()
+        self.camera.destroy()
+        if self.view_fbo:
+            self.view_fbo.release()
+        self.profiler.destroy()
+        self.fbo.release()
+        self.ctx.release()
+
+
+def export_range(models_data, out, first, last, fps=SIMULATION_RATE, win_size=(1600, 900),
+                 fmt='png', perspectiva=True, ward=False, backend='egl', ecg=None, partitioned=False):
+    # render frames [first, last) of the sequence; every worker fast-forwards from the
+    # same initial state, so the ranges of a split export join seamlessly
+    # frames where no heart moved reuse the previous picture
+    engine = HeadlessEngine(models_data, win_size, ward, backend, partitioned, dirty=True)
+    engine.camera.perspectiva = perspectiva
+    if ecg and not ward:
+        # ecg: EcgPlayback arguments, every heart replays the recording from its start
+        for heart in engine.scene.objects:
+            engine.scene.attach_recording(EcgPlayback(**ecg), heart)
+    engine.seek(first, fps)
+    frame_size = win_size[0] * win_size[1] * 3
+    stream = open(out, 'r+b') if fmt == 'raw' else None
+    try:
+        for frame in range(first, last):
+            data = engine.render_frame()
+            if fmt == 'raw':
+                stream.seek(frame * frame_size)
+                stream.write(data)
+            else:
+                image = pg.image.frombuffer(data, win_size, 'RGB')
+                pg.image.save(image, os.path.join(out, f'frame_{frame:06d}.png'))
+            engine.seek(frame + 1, fps)
+    finally:
+        if stream:
+            stream.close()
+        engine.destroy()
+    return last - first
+
+
+def export(models_data, out, duration, fps=30, win_size=(1600, 900), fmt='png', workers=1, **kwargs):
+    # write duration seconds of animation as numbered PNGs in the out folder or as one
+    # raw RGB24 stream (frames of win_size, top row first), split across workers processes
+    frames = round(duration * fps)
+    if fmt == 'raw':
+        with open(out, 'wb') as stream:
+            stream.truncate(frames * win_size[0] * win_size[1] * 3)
+    else:
+        os.makedirs(out, exist_ok=True)
+    bounds = np.linspace(0, frames, workers + 1).round().astype(int)
+    ranges = [(int(first), int(last)) for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+    if workers == 1:
+        return sum(export_range(models_data, out, first, last, fps, win_size, fmt, **kwargs) for first, last in ranges)
+    # GL contexts do not survive a fork, every worker starts a fresh interpreter
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as pool:
+        jobs = [pool.submit(export_range, models_data, out, first, last, fps, win_size, fmt, **kwargs)
+                for first, last in ranges]
+        return sum(job.result() for job in jobs)
+
+
+def get_models_data(rhythm, seed=None):
+    # same rhythms as the launcher ("Normal", "Arritmia", "Normal vs Arritmia", ...)
+    from app import App
+    launcher = App.__new__(App)  # the model helpers of the launcher do not touch Tk
+    if ' vs ' in rhythm:
+        return launcher.get_model_data('Comparación', rhythm, seed)
+    return launcher.get_model_data(rhythm, '', seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the heart simulation offscreen to PNG frames or a raw RGB stream')
+    parser.add_argument('rhythm', help='Normal, Taquicardia, Bradicardia, Arritmia, Fibrilacion, Extrasistole or "A vs B"')
+    parser.add_argument('out', help='output folder (png) or file (raw)')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of animation')
+    parser.add_argument('--fps', type=int, default=30, help='frames per second, the frames between two simulation steps are interpolated')
+    parser.add_argument('--size', default='1600x900', help='frame size WxH')
+    parser.add_argument('--format', choices=['png', 'raw'], default='png')
+    parser.add_argument('--workers', type=int, default=1, help='processes to split the frames across')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the generated rhythm')
+    parser.add_argument('--ortho', action='store_true', help='4-view orthographic layout')
+    parser.add_argument('--backend', default='egl', help="moderngl standalone backend, '' for the platform default")
+    parser.add_argument('--partitioned', action='store_true', help='draw the heart as its separate regions')
+    parser.add_argument('--ecg', help='ECG recording (raw int16 or CSV) whose R-peaks drive the beat')
+    parser.add_argument('--ecg-rate', type=int, default=ECG_RATE, help='samples per second of the recording')
+    parser.add_argument('--ecg-channel', type=int, default=0, help='lead (raw) or column (CSV) of the recording')
+    args = parser.parse_args()
+
+    win_size = tuple(int(n) for n in args.size.split('x'))
+    models_data = get_models_data(args.rhythm, args.seed)
+    frames = export(models_data, args.out, args.duration, args.fps, win_size, args.format, args.workers,
+                    perspectiva=not args.ortho, backend=args.backend, partitioned=args.partitioned,
+                    ecg=args.ecg and {'path': args.ecg, 'rate': args.ecg_rate, 'channel': args.ecg_channel})
+    print(f'{frames} frames written to {args.out}')
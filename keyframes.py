@@ -0,0 +1,68 @@
+import copy
+from collections import OrderedDict
+import numpy as np
+
+# keyframes baked per beat cycle: the morph weights of the mesh at evenly spaced phases, a
+# keyframe mesh is the base plus the targets blended with them
+# Accuracy: the live animation steps on the simulation clock, so from beat to beat its
+# weights at a phase vary by up to one step of the morph ramps, which the keyframes can
+# only average. Against the live gpu path the baked weights are off by at most 0.017 at
+# 35 ppm, 0.0025 at 60 and 0.002 at 150, but 0.10 at 250 ppm, where a step moves them by
+# 0.18. More keyframes do not lower that bound, fewer add interpolation error mid-range
+KEYFRAME_COUNT = 64
+# steady beats averaged into the keyframes
+CYCLES = 16
+
+
+class KeyframeCache:
+    # bounded LRU of baked beat cycles keyed by (ppm, keyframe count)
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key, loader):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = loader()
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+KEYFRAME_CACHE = KeyframeCache()
+
+
+def cycle_samples(heart, cycles=CYCLES):
+    # (phases, morph weights) of every simulation step of cycles beats at amplitude 1, after
+    # the first one from rest, simulated on a throwaway copy of the heart so its own
+    # animation state is left untouched
+    beat = copy.copy(heart)
+    beat.beat_mask, beat.beat_stream, beat.tempo, beat.ppm_schedule = [1.0], None, 0, None
+    beat.animation_progress_1 = beat.animation_progress_2 = beat.animation_progress_3 = 0.0
+    samples = []
+    for cycle in range(cycles + 1):
+        phases, weights = [], []
+        while True:
+            phases.append(beat.animation_progress_1)
+            weights.append(list(beat.get_morph_weights()))
+            phase = beat.animation_progress_1
+            beat.update_progress()
+            if beat.animation_progress_1 < phase:
+                break
+        if cycle:
+            samples.append((np.array(phases), np.array(weights)))
+    return samples
+
+
+def cycle_weights(heart, count=KEYFRAME_COUNT):
+    # morph weights at count + 1 evenly spaced phases of one beat (both ends included,
+    # the cycle jumps back to rest when it wraps) at amplitude 1, the mean over the cycles:
+    # the steps fall on other phases every beat
+    keyframes = np.linspace(0.0, 1.0, count + 1)
+    tables = [np.stack([np.interp(keyframes, phases, weights[:, i]) for i in range(3)], axis=1)
+              for phases, weights in cycle_samples(heart)]
+    return np.mean(tables, axis=0).astype('f4')
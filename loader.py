@@ -0,0 +1,129 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+import numpy as np
+from lod import load_lods
+from mesh_cache import MORPH_SETS, cache_path, compile_mesh, load_indexed_mesh, source_hash
+from model import HEART_MESH, HEART_TEXTURE
+from texture_cache import load_texture
+
+
+class AssetLoader:
+    # CPU side of loading a scene (OBJ parsing in worker processes, texture decoding and mesh
+    # welding in threads) while the caller keeps its event loop running; the results go
+    # to AssetRegistry(prefetched=...) and the GPU uploads stay on the GL thread
+    processes = None  # shared by every load, spawning it is the slow part
+
+    def __init__(self, meshes=(HEART_MESH,), textures=(HEART_TEXTURE,)):
+        self.meshes = list(dict.fromkeys(meshes))
+        self.textures = list(dict.fromkeys(textures))
+        self.prefetched = {}
+        self.futures = []
+        self.threads = None
+
+    def start(self):
+        self.threads = ThreadPoolExecutor(max_workers=4)
+        for path in self.textures:
+            self.submit(self.threads, ('texture_data', path), self.load_texture, path)
+        pending = self.pending_sources(self.meshes)
+        for path in self.meshes:
+            # every source file that is not compiled yet is parsed in its own process
+            compiled = [self.compile(source, len(pending)) for source in [path, *MORPH_SETS.get(path, [])]
+                        if source in pending]
+            mesh = self.submit(self.threads, ('mesh', path), self.load_mesh_set, path, compiled)
+            self.submit(self.threads, ('lods', path), self.load_lods, path, mesh)
+        return self
+
+    def compile(self, source, workers):
+        try:
+            return self.submit(self.get_processes(workers), None, compile_mesh, source)
+        except BrokenProcessPool:
+            # a worker died in an earlier load, start over with a new pool
+            AssetLoader.processes = None
+            return self.submit(self.get_processes(workers), None, compile_mesh, source)
+
+    @staticmethod
+    def pending_sources(meshes):
+        # OBJ files of the meshes and their morph targets without a compiled cache, the only
+        # work that goes to the processes (textures are decoded in threads)
+        return [source for path in dict.fromkeys(meshes) for source in [path, *MORPH_SETS.get(path, [])]
+                if not os.path.exists(cache_path(source, source_hash(source)))]
+
+    @classmethod
+    def warm_up(cls, meshes=(HEART_MESH,)):
+        # spawn the workers now (e.g. while the launcher waits for a click) instead of on the
+        # first load, one per file it will compile: none when they are all cached
+        workers = len(cls.pending_sources(meshes))
+        if not workers:
+            return
+        pool = cls.get_processes(workers)
+        for _ in range(workers):
+            pool.submit(os.getpid)
+
+    @classmethod
+    def get_processes(cls, workers):
+        if AssetLoader.processes is None:
+            # a fresh interpreter per worker, forking would copy the launcher's Tk/GL state
+            AssetLoader.processes = ProcessPoolExecutor(max_workers=min(workers, os.cpu_count()),
+                                                        mp_context=get_context('spawn'))
+        return AssetLoader.processes
+
+    @classmethod
+    def close(cls):
+        # on exit: stop the workers, dropping what they still had queued
+        if AssetLoader.processes is not None:
+            AssetLoader.processes.shutdown(cancel_futures=True)
+            AssetLoader.processes = None
+
+    def submit(self, pool, key, fn, *args):
+        future = pool.submit(fn, *args)
+        if key is not None:
+            future.add_done_callback(lambda future: self.store(key, future))
+        self.futures.append(future)
+        return future
+
+    def store(self, key, future):
+        if not future.cancelled() and future.exception() is None:
+            self.prefetched[key] = future.result()
+
+    def load_mesh_set(self, path, compiled):
+        wait(compiled)
+        for future in compiled:
+            future.result()  # re-raise parse errors here
+        return load_indexed_mesh(path, MORPH_SETS.get(path, []))
+
+    def load_texture(self, path):
+        # read in here, not page by page on the GL thread during the upload
+        return np.array(load_texture(path))
+
+    def load_lods(self, path, mesh):
+        # after the mesh set, which writes the welded mesh the levels are built from
+        mesh.result()
+        return load_lods(path, MORPH_SETS.get(path, []))
+
+    @property
+    def progress(self):
+        # finished fraction of the submitted jobs
+        if not self.futures:
+            return 1.0
+        return sum(future.done() for future in self.futures) / len(self.futures)
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def error(self):
+        for future in self.futures:
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                return future.exception()
+        return None
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        self.prefetched.clear()
+
+    def shutdown(self):
+        if self.threads:
+            self.threads.shutdown(wait=False)
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import sys
+import numpy as np
+from mesh_cache import MORPH_SETS, cache_path, load_indexed_mesh, source_hash, store
+
+# levels of detail of a welded mesh, as fractions of its vertices; a level is only a new
+# index buffer over a subset of the original vertices, so the vertex buffer and every
+# morph target keep working unchanged at every level
+LOD_RATIOS = (1.0, 0.5, 0.25, 0.125)
+# projected bounding sphere radius (pixels) below which each further level is used
+LOD_PIXELS = (160, 80, 40)
+
+
+def uv_charts(indices, count):
+    # connected pieces of the uv layout: the welded mesh splits a vertex at every uv seam,
+    # so triangles only connect vertices of the same chart
+    triangles = np.asarray(indices, dtype=int).reshape(-1, 3)
+    chart = np.arange(count)
+    while True:
+        smallest = chart[triangles].min(axis=1)
+        updated = chart.copy()
+        for corner in range(3):
+            np.minimum.at(updated, triangles[:, corner], smallest)
+        updated = updated[updated]
+        if np.array_equal(updated, chart):
+            return chart
+        chart = updated
+
+
+def cluster_vertices(vertex_data, cell, point, chart):
+    # vertex clustering on a grid of cell size: every vertex of a cell moves to one point,
+    # so the surface stays closed, taking the copy of that point in its own uv chart
+    # (point: id of each vertex position, chart: uv_charts of each vertex)
+    vertices = np.asarray(vertex_data).reshape(-1, 8)
+    texcoords, positions = vertices[:, :2], vertices[:, 5:]
+    keys = np.floor((positions - positions.min(axis=0)) / cell).astype('i8')
+    _, cluster = np.unique(keys, axis=0, return_inverse=True)
+    cluster = cluster.ravel()
+    # charts each point belongs to (the copies of a seam point sit in several)
+    point_charts = np.bincount(np.unique(np.column_stack([point, chart]), axis=0)[:, 0], minlength=point.max() + 1)
+
+    # the point of a cell is the one shared by most charts (a seam point when the cell
+    # spans a seam), then the closest one to the cell centroid
+    count = cluster.max() + 1
+    centroid = np.stack([np.bincount(cluster, positions[:, i], count) for i in range(3)], axis=1)
+    centroid /= np.bincount(cluster, minlength=count)[:, None]
+    distance = ((positions - centroid[cluster]) ** 2).sum(axis=1)
+    order = np.lexsort((distance, -point_charts[point], cluster))
+    first = np.r_[True, cluster[order][1:] != cluster[order][:-1]]
+    representative = np.empty(count, dtype=int)
+    representative[cluster[order][first]] = order[first]
+
+    # every vertex takes the copy of its cell's point in its chart, or the closest uv
+    by_point = np.argsort(point, kind='stable')
+    start = np.searchsorted(point[by_point], np.arange(point.max() + 1))
+    copies = np.bincount(point)
+    vertex_map = representative[cluster]
+    target = point[vertex_map]
+
+    def mismatch(candidate, vertex):
+        uv = ((texcoords[candidate] - texcoords[vertex]) ** 2).sum(axis=1)
+        return uv + (chart[candidate] != chart[vertex]) * 1e3
+
+    best = mismatch(vertex_map, np.arange(len(vertices)))
+    for k in range(1, copies.max()):
+        has = np.flatnonzero(copies[target] > k)
+        candidate = by_point[start[target[has]] + k]
+        gap = mismatch(candidate, has)
+        closer = gap < best[has]
+        vertex_map[has[closer]] = candidate[closer]
+        best[has[closer]] = gap[closer]
+    return vertex_map
+
+
+def collapse(indices, vertex_map):
+    # triangles with their corners moved to the representatives, without the ones that
+    # collapsed to a line or a point or that became duplicates
+    triangles = vertex_map[np.asarray(indices)].reshape(-1, 3)
+    keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])
+    triangles = triangles[keep]
+    _, unique = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    return triangles[np.sort(unique)].ravel().astype(np.asarray(indices).dtype)
+
+
+def decimate(vertex_data, indices, ratio, iterations=24):
+    # index buffer using about ratio of the referenced vertices, the cell size is bisected
+    used = len(np.unique(indices))
+    positions = np.asarray(vertex_data).reshape(-1, 8)[:, 5:]
+    point = np.unique(positions, axis=0, return_inverse=True)[1].ravel()
+    chart = uv_charts(indices, len(positions))
+    low, high = 0.0, float(np.ptp(positions, axis=0).max())
+    best = np.asarray(indices)
+    for _ in range(iterations):
+        cell = (low + high) / 2
+        lod = collapse(indices, cluster_vertices(vertex_data, cell, point, chart))
+        if len(np.unique(lod)) > ratio * used:
+            low = cell
+        else:
+            high, best = cell, lod
+        if abs(len(np.unique(best)) - ratio * used) < 0.02 * ratio * used:
+            break
+    return best
+
+
+def load_lods(path, target_paths=(), ratios=LOD_RATIOS):
+    # index buffers of every level (the first one is the full mesh), built once and cached
+    indices, vertex_data, _ = load_indexed_mesh(path, target_paths)
+    key = ''.join(source_hash(p) for p in [path, *target_paths]) + repr(ratios)
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    cached = [cache_path(path, digest).replace(f'.{digest}.npy', f'.lod.{digest}.{level}.npy')
+              for level in range(1, len(ratios))]
+    if not all(os.path.exists(name) for name in cached):
+        for name, ratio in zip(cached, ratios[1:]):
+            store(name, decimate(vertex_data, indices, ratio), depth=2)
+    return [indices, *[np.load(name, mmap_mode='r') for name in cached]]
+
+
+def mesh_bounds(vertex_data, targets=()):
+    # (center, radius) of a sphere around the mesh in every morph target
+    positions = np.vstack([np.asarray(mesh).reshape(-1, 8)[:, 5:] for mesh in [vertex_data, *targets]])
+    center = (positions.min(axis=0) + positions.max(axis=0)) / 2
+    return center, float(np.sqrt(((positions - center) ** 2).sum(axis=1).max()))
+
+
+def report(path, target_paths=()):
+    for level, lod in enumerate(load_lods(path, target_paths)):
+        print(f'{path} LOD {level}: {len(np.unique(lod))} vertices, {len(lod) // 3} triangles')
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:] or MORPH_SETS:
+        report(path, MORPH_SETS.get(path, []))
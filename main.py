@@ -1,14 +1,22 @@
 import pygame as pg
 import moderngl as mgl
-import sys
+import time
 from model import *
-from camera import Camera
+from camera import ORTHO_VIEWS, PERSPECTIVE_VIEW, Camera
+from clock import SimulationClock
 from light import Light
+from picking import HeartPicker
 from scene import Scene
+from profiler import FrameProfiler, ProfilerHud
+
+CLEAR_COLOR = (0.08, 0.16, 0.18)
+# frame rate limits F5 cycles through, 0: uncapped (or the vsync rate)
+FRAME_CAPS = (60, 30, 0)
 
 
 class GraphicsEngine:
-    def __init__(self, models_data, win_size):
+    def __init__(self, models_data, win_size, ward=False, profile_csv=None, prefetched=None, launch_time=None,
+                 partitioned=False, dirty=False, max_fps=60, vsync=False):
         # init pygame modules
         pg.init()
         # window size
@@ -18,90 +26,202 @@ class GraphicsEngine:
         pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
         pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
         # create opengl context
-        pg.display.set_mode(self.WIN_SIZE, flags=pg.OPENGL | pg.DOUBLEBUF)
-        # mouse settings
-        pg.event.set_grab(True)
-        pg.mouse.set_visible(False)
+        pg.display.set_mode(self.WIN_SIZE, flags=pg.OPENGL | pg.DOUBLEBUF, vsync=int(vsync))
         # detect and use existing opengl context
         self.ctx = mgl.create_context()
         # self.ctx.front_face = 'cw'
         self.ctx.enable(flags=mgl.DEPTH_TEST | mgl.CULL_FACE)
+        # keyboard and mouse drive the camera and the heart rotation
+        self.interactive = True
         # create an object to help track time
         self.clock = pg.time.Clock()
         self.time = 0
         self.delta_time = 0
+        # frames are drawn at up to max_fps (0: as fast as they come), the hearts beat on the
+        # fixed steps of the simulation clock whatever the frame rate
+        self.max_fps = max_fps
+        self.simulation = SimulationClock()
+        # frame profiler (F3 shows it on screen, profile_csv streams every frame to a file)
+        self.profiler = FrameProfiler(self.ctx, csv_path=profile_csv)
+        self.hud = ProfilerHud(self, self.profiler)
         # light
         self.light = Light()
         # camera
         self.camera = Camera(self)
         # scene
-        self.scene = Scene(self, models_data)
+        self.scene = Scene(self, models_data, ward, prefetched, partitioned)
+        # left click: heart, region and surface point under the mouse
+        self.picker = HeartPicker(self)
+        self.picked = None
+        # perf_counter() of the launcher click, to report the time to the first frame
+        self.launch_time = launch_time
+        # ESC pauses the session (run() returns), closing the window ends it
+        self.running = False
+        self.closed = False
+        # dirty: only the views whose hearts or camera changed are drawn, into an offscreen
+        # copy of the window (view_fbo), and the window is only redrawn when one did (F4)
+        self.dirty = dirty
+        self.view_fbo = None
+        self.view_states = {}  # viewport -> state of the hearts and camera it was drawn with
+        self.exposed = True  # the window lost its contents, show the copy again
+
+    def load(self, models_data, ward=False, launch_time=None):
+        # switch scenes keeping the window, the GL context and the loaded assets
+        self.scene.reload(models_data, ward)
+        self.picker.clear()
+        self.picked = None
+        self.camera.zoom = glm.vec3((0,0,0))
+        self.view_states.clear()
+        self.launch_time = launch_time
+
+    def close(self):
+        self.scene.destroy()
+        self.camera.destroy()
+        if self.view_fbo:
+            self.view_fbo.release()
+        self.hud.destroy()
+        self.profiler.destroy()
+        pg.quit()
+        self.running = False
+        self.closed = True
 
     def check_events(self):
         for event in pg.event.get():
-            if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
-                pg.quit()
-                sys.exit()
-                    
+            if event.type == pg.QUIT:
+                self.close()
+                return
+
+            if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+                self.running = False
+                
             if event.type == pg.KEYDOWN and event.key == pg.K_p:
                 self.camera.perspectiva = not self.camera.perspectiva
                 self.camera.zoom = glm.vec3((0,0,0))
-                
-    def render(self):
-        # clear framebuffer
-        self.ctx.clear(color=(0.08, 0.16, 0.18))
 
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                self.hud.toggle()
+
+            if event.type == pg.KEYDOWN and event.key == pg.K_F5:
+                self.max_fps = FRAME_CAPS[(FRAME_CAPS.index(self.max_fps) + 1) % len(FRAME_CAPS)] \
+                    if self.max_fps in FRAME_CAPS else FRAME_CAPS[0]
+
+            if event.type == pg.KEYDOWN and event.key == pg.K_F4:
+                self.dirty = not self.dirty
+                self.view_states.clear()
+
+            if event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
+                self.pick(event.pos)
+
+            if event.type in (pg.WINDOWEXPOSED, pg.VIDEOEXPOSE):
+                self.exposed = True
+
+    def pick(self, pixel):
+        with self.profiler.stage('pick'):
+            # the frame on screen was animated with the clock's current alpha
+            self.picked = self.picker.pick(pixel, self.simulation.alpha)
+        # the HUD (F3) shows the new pick without waiting for its next refresh
+        self.hud.texture_dirty = True
+
+    def render(self):
+        if self.dirty:
+            changed = self.render_dirty_views(self.ctx.screen)
+        else:
+            self.render_views()
+            changed = True
+        with self.profiler.stage('animate'):
+            steps = self.simulation.advance(self.delta_time)
+            self.scene.animate(steps, self.simulation.alpha)
+        # nothing new to show: the window keeps the last frame, no swap
+        if changed or self.exposed or self.hud.visible:
+            if self.dirty and not changed:
+                self.ctx.copy_framebuffer(self.ctx.screen, self.view_fbo)
+            self.exposed = False
+            self.hud.render()
+            # swap buffers
+            with self.profiler.stage('flip'):
+                pg.display.flip()
+
+    def get_views(self):
+        # (name, viewport, camera position/up/forward) of every view of the current layout
         if self.camera.perspectiva:
-            self.ctx.viewport = (0,0,self.WIN_SIZE[0],self.WIN_SIZE[1])
-            self.camera.update((0, -2, -6),(0, 1, 0), (0, 0, -1))
+            return [('perspectiva', (0, 0, *self.WIN_SIZE), PERSPECTIVE_VIEW)]
+        # alzado, perfil, axonométrica y planta, cada una en un cuarto de la ventana
+        width, height = self.WIN_SIZE[0] // 2, self.WIN_SIZE[1] // 2
+        several = len(self.scene.objects) > 1
+        return [(name, (column * width, row * height, width, height), views[several])
+                for name, ((column, row), *views) in ORTHO_VIEWS.items()]
+
+    def render_views(self):
+        # clear framebuffer
+        self.ctx.clear(color=CLEAR_COLOR)
+        for name, viewport, view in self.get_views():
+            self.ctx.viewport = viewport
+            self.camera.update(*view)
+            self.render_view(name)
+        if self.camera.perspectiva and self.interactive:
             self.camera.move()
-            self.scene.render()
-        else:
-            # Vista Alzado
-            self.ctx.viewport = (0, self.WIN_SIZE[1] // 2, self.WIN_SIZE[0] // 2, self.WIN_SIZE[1] // 2)
-            if len(self.scene.objects) > 1:
-                self.camera.update((0, -2, -7),(0, 1, 0), (0, 0, -1))
-            else:
-                self.camera.update((0, -2, -7.5),(0, 1, 0), (0, 0, -1))
-            self.scene.render()
-
-            # Vista Perfil
-            self.ctx.viewport = (0, 0, self.WIN_SIZE[0] // 2, self.WIN_SIZE[1] // 2)
-            if len(self.scene.objects) > 1:
-                self.camera.update((-3.5, -2, -10), (0, 1, 0), (1, 0, 0))
-            else:
-                self.camera.update((-2.5, -2, -10), (0, 1, 0), (1, 0, 0))
-            self.scene.render()
 
-            # Vista Axonométrica
-            self.ctx.viewport = (self.WIN_SIZE[0] // 2, 0, self.WIN_SIZE[0] // 2, self.WIN_SIZE[1] // 2)
-            if len(self.scene.objects) > 1:
-                self.camera.update((-1.5, -2, -7), (0, 1, 0), glm.normalize(glm.vec3(0, -2, -10) - glm.vec3(-1.5, -2, -7))) 
-            else:
-                self.camera.update((-1.5, -2, -8), (0, 1, 0), glm.normalize(glm.vec3(0, -2, -10) - glm.vec3(-1.5, -2, -8))) 
-            self.scene.render()
+    def render_dirty_views(self, target):
+        # draw the views whose hearts or camera changed since they were last drawn into
+        # view_fbo and copy it to target; False when every view is still the same
+        if self.view_fbo is None:
+            self.view_fbo = self.ctx.framebuffer(color_attachments=[self.ctx.renderbuffer(self.WIN_SIZE)],
+                                                 depth_attachment=self.ctx.depth_renderbuffer(self.WIN_SIZE))
+        views = self.get_views()
+        if {viewport for _, viewport, _ in views} != set(self.view_states):
+            # another layout drew over the copy
+            self.view_states.clear()
+        hearts = tuple(obj.get_state() for obj in self.scene.objects)
+        self.view_fbo.use()
+        changed = False
+        for name, viewport, view in views:
+            state = (view, tuple(self.camera.zoom), hearts)
+            if self.view_states.get(viewport) == state:
+                continue
+            self.view_states[viewport] = state
+            self.view_fbo.clear(*CLEAR_COLOR, viewport=viewport)
+            self.ctx.viewport = viewport
+            self.camera.update(*view)
+            self.render_view(name)
+            changed = True
+        if self.camera.perspectiva and self.interactive:
+            self.camera.move()
+        if changed:
+            self.ctx.copy_framebuffer(target, self.view_fbo)
+        target.use()
+        return changed
 
-            # Vista Planta 
-            self.ctx.viewport = (self.WIN_SIZE[0] // 2, self.WIN_SIZE[1] // 2, self.WIN_SIZE[0] // 2, self.WIN_SIZE[1] // 2)
-            if len(self.scene.objects) > 1:
-                self.camera.update((0, 1.5, -10), (0, 0, -1), (0, -1, 0))
-            else:
-                self.camera.update((0, 0.5, -10), (0, 0, -1), (0, -1, 0))
+    def render_view(self, name):
+        with self.profiler.stage(f'view {name}'), self.profiler.gpu(f'view {name}'):
             self.scene.render()
 
-        self.scene.animate()
-        # swap buffers
-        pg.display.flip()
-
     def get_time(self):
         self.time = pg.time.get_ticks() * 0.001
 
     def run(self):
-        while True:
+        # mouse settings
+        pg.event.set_grab(True)
+        pg.mouse.set_visible(False)
+        self.clock.tick()
+        self.running = True
+        while self.running:
+            self.profiler.begin_frame()
             self.get_time()
-            self.check_events()
+            with self.profiler.stage('events'):
+                self.check_events()
+            if not self.running:
+                break
             self.render()
-            self.delta_time = self.clock.tick(60)
+            if self.launch_time is not None:
+                self.profiler.first_frame((time.perf_counter() - self.launch_time) * 1000)
+                self.launch_time = None
+            with self.profiler.stage('tick'):
+                self.delta_time = self.clock.tick(self.max_fps)
+            self.profiler.end_frame()
+        # back to the launcher, the window keeps its last frame
+        if not self.closed:
+            pg.event.set_grab(False)
+            pg.mouse.set_visible(True)
 
 """
 if __name__ == '__main__':
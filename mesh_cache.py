@@ -0,0 +1,177 @@
+import hashlib
+import os
+import sys
+import time
+import numpy as np
+import pywavefront
+
+# compiled meshes live here, one T2F_N3F_V3F float32 .npy per source file and content hash
+CACHE_DIR = 'objects/.cache'
+# base meshes and their morph targets, in the order the animation steps use them
+MORPH_SETS = {
+    'objects/heart/base.obj': ['objects/heart/updated_abaix.obj',
+                               'objects/heart/updated_ventricula.obj',
+                               'objects/heart/updated_arterias.obj'],
+}
+# vertex format of each mesh on the GPU (gpu morph): 'float' or 'compact' (quantize.py)
+VERTEX_FORMATS = {
+    'objects/heart/base.obj': 'float',
+}
+# vertices that move less than this in a morph target are left out of its sparse deltas
+SPARSE_TOLERANCE = 1e-6
+
+
+def source_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.blake2b(file.read(), digest_size=8).hexdigest()
+
+
+def cache_path(path, digest):
+    name = os.path.relpath(os.path.abspath(path), os.path.abspath('objects')).replace(os.sep, '__')
+    return os.path.join(CACHE_DIR, f'{name}.{digest}.npy')
+
+
+def load_mesh(path):
+    # mmap the compiled mesh, compiling it first if the source changed
+    cached = cache_path(path, source_hash(path))
+    if not os.path.exists(cached):
+        compile_mesh(path, cached)
+    return np.load(cached, mmap_mode='r')
+
+
+def load_indexed_mesh(path, target_paths=()):
+    # welded (indices, vertices, targets) for a base mesh and its morph targets, all
+    # meshes share the same index buffer so a vertex means the same point in every target
+    paths = [path, *target_paths]
+    digest = hashlib.blake2b(''.join(source_hash(p) for p in paths).encode(), digest_size=8).hexdigest()
+    cached = [cache_path(path, digest).replace('.npy', f'.{part}.npy') for part in ['indices', *range(len(paths))]]
+    if not all(os.path.exists(name) for name in cached):
+        indices, meshes = weld([load_mesh(p) for p in paths])
+        for name, array in zip(cached, [indices, *meshes]):
+            store(name, array, depth=2)
+    indices, *meshes = [np.load(name, mmap_mode='r') for name in cached]
+    return indices, meshes[0], meshes[1:]
+
+
+def weld(meshes):
+    # merge the vertices whose (uv, normal, position) tuple is identical in every mesh
+    rows = np.hstack([np.asarray(mesh).reshape(-1, 8) for mesh in meshes])
+    keys = np.ascontiguousarray(rows).view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # number the unique vertices in order of first use to keep the original locality
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    unique = rows[first[order]]
+    indices = rank[inverse.ravel()].astype('u2' if len(unique) < 2 ** 16 else 'u4')
+    return indices, [np.ascontiguousarray(unique[:, 8 * i:8 * (i + 1)]).reshape(-1) for i in range(len(meshes))]
+
+
+def sparse_deltas(vertex_data, end_vertices, tolerance=SPARSE_TOLERANCE):
+    # (indices, normal/position deltas) of the vertices a morph target actually moves
+    deltas = np.asarray(end_vertices).reshape(-1, 8)[:, 2:] - np.asarray(vertex_data).reshape(-1, 8)[:, 2:]
+    indices = np.flatnonzero(np.abs(deltas).max(axis=1) > tolerance)
+    return indices, np.ascontiguousarray(deltas[indices], dtype='f4')
+
+
+def dirty_ranges(indices, gap=32):
+    # [start, end) vertex runs covering the sorted indices, runs closer than gap are merged
+    if len(indices) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) > gap)
+    starts = indices[np.r_[0, breaks + 1]]
+    ends = indices[np.r_[breaks, len(indices) - 1]] + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def report_sparsity(path, target_paths, tolerance=SPARSE_TOLERANCE):
+    _, vertex_data, targets = load_indexed_mesh(path, target_paths)
+    total = len(vertex_data) // 8
+    for target_path, end_vertices in zip(target_paths, targets):
+        indices, _ = sparse_deltas(vertex_data, end_vertices, tolerance)
+        print(f'{target_path}: {len(indices)}/{total} vertices move ({len(indices) / total:.1%}), '
+              f'{len(dirty_ranges(indices))} upload ranges, tolerance {tolerance:g}')
+
+
+def compile_mesh(path, cached=None):
+    cached = cached or cache_path(path, source_hash(path))
+    vertex_data = parse_obj(path)
+    store(cached, vertex_data)
+    return vertex_data
+
+
+def store(cached, array, depth=1):
+    # cache names are <source>.<digest>[.<part>].npy, depth counts the fields after <source>
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # drop the entries compiled from older versions of the same source
+    stem, digest = os.path.basename(cached).rsplit('.', depth + 1)[:2]
+    for name in os.listdir(CACHE_DIR):
+        fields = name.rsplit('.', depth + 1)
+        if name.endswith('.npy') and len(fields) == depth + 2 and fields[0] == stem and fields[1] != digest:
+            os.remove(os.path.join(CACHE_DIR, name))
+    # write under a temporary name so a concurrent reader never sees half a file
+    tmp = f'{cached}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp, cached)
+
+
+def parse_obj(path):
+    # vectorized reader for the v/vt/vn + f a/b/c meshes in objects/, it emits the
+    # same de-indexed T2F_N3F_V3F layout (and fan triangulation) as pywavefront
+    with open(path) as file:
+        lines = file.read().splitlines()
+
+    def floats(prefix, width):
+        values = ' '.join(line[len(prefix):] for line in lines if line.startswith(prefix)).split()
+        # parse as double first so the float32 rounding matches pywavefront
+        return np.array(values, dtype='f8').astype('f4').reshape(-1, width)
+
+    faces = [line.split()[1:] for line in lines if line.startswith('f ')]
+    sizes = {len(face) for face in faces}
+    # anything else (missing vt/vn, mixed polygon sizes) goes through pywavefront
+    if len(sizes) != 1 or any(token.count('/') != 2 or '//' in token for token in faces[0]):
+        return parse_obj_pywavefront(path)
+    positions, texcoords, normals = floats('v ', 3), floats('vt ', 2), floats('vn ', 3)
+
+    n = sizes.pop()
+    index = np.array(' '.join(' '.join(face) for face in faces).replace('/', ' ').split(), dtype='i8')
+    index = index.reshape(-1, n, 3)
+    # (v1, v2, v3), then (vj, v1, vj-1) for every further vertex
+    fan = [(0, 1, 2)] + [(j, 0, j - 1) for j in range(3, n)]
+    index = index[:, fan].reshape(-1, 3)
+
+    counts = (len(positions), len(texcoords), len(normals))
+    index = np.where(index < 0, index + counts, index - 1)
+    vertex_data = np.hstack([texcoords[index[:, 1]], normals[index[:, 2]], positions[index[:, 0]]])
+    return vertex_data.reshape(-1)
+
+
+def parse_obj_pywavefront(path):
+    objs = pywavefront.Wavefront(path, parse=True)
+    obj = objs.materials.popitem()[1]
+    return np.array(obj.vertices, dtype='f4')
+
+
+def prebuild(root='objects'):
+    # compile every OBJ under root and report cold (parse) and warm (mmap) load times
+    for folder, _, files in os.walk(root):
+        if os.path.abspath(folder).startswith(os.path.abspath(CACHE_DIR)):
+            continue
+        for name in sorted(files):
+            if not name.endswith('.obj'):
+                continue
+            path = os.path.join(folder, name)
+            start = time.perf_counter()
+            vertex_data = compile_mesh(path)
+            cold = time.perf_counter() - start
+            start = time.perf_counter()
+            np.asarray(load_mesh(path)).sum()
+            warm = time.perf_counter() - start
+            print(f'{path}: {len(vertex_data) // 8} vertices, cold {cold * 1000:.1f} ms, warm {warm * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    prebuild(*sys.argv[1:])
+    for path, target_paths in MORPH_SETS.items():
+        report_sparsity(path, target_paths)
@@ -1,29 +1,126 @@
 import glm
 import numpy as np
 import moderngl as mgl
-import pywavefront
 import pygame as pg
+from assets import AssetRegistry
+from camera import CAMERA_BINDING, CAMERA_BLOCK, NEAR
+from clock import SIMULATION_RATE
+from keyframes import KEYFRAME_CACHE, KEYFRAME_COUNT, cycle_weights
+from lod import LOD_PIXELS, load_lods, mesh_bounds
+from mesh_cache import MORPH_SETS, VERTEX_FORMATS, load_mesh, load_indexed_mesh, sparse_deltas
+from morph import MorphBatch
+from quantize import COMPACT_FORMAT, COMPACT_TARGET_FORMAT, compact_mesh
+from texture_cache import load_texture
+
+HEART_MESH = 'objects/heart/base.obj'
+HEART_TEXTURE = 'objects/heart/texture_diffuse.png'
+
+
+def add_defines(source, defines):
+    # #define lines right after the #version line of a shader
+    version, rest = source.split('\n', 1)
+    return '\n'.join([version, *[f'#define {name}' for name in defines], rest])
+
+
+def add_includes(source):
+    # every #include "name" line of a shader replaced with shaders/name, GLSL has no includes
+    lines = source.split('\n')
+    for i, line in enumerate(lines):
+        if line.startswith('#include'):
+            name = line.split('"')[1]
+            with open(f'shaders/{name}') as file:
+                lines[i] = file.read()
+    return '\n'.join(lines)
 
 
 class Heart:
-    def __init__(self, app, pos=(0, 0, 0), rot=(0, 0, 0), scale=(1, 1, 1), ppm=60, mask=[1]):
+    program_name = 'default'
+    mesh_path = HEART_MESH
+    texture_path = HEART_TEXTURE
+    ppm_schedule = None
+
+    def __init__(self, app, pos=(0, 0, 0), rot=(0, 0, 0), scale=(1, 1, 1), ppm=60, mask=[1], morph='gpu', assets=None, vertex_format=None):
         self.app = app
         self.ctx = app.ctx
+        # assets shared with the other hearts of the scene
+        self.assets = assets if assets is not None else AssetRegistry(self.ctx)
+        self.asset_keys = []
         self.pos = pos
         #treballarem amb aquest self.rot per fer les rotacions del cor
         self.rot = glm.vec3([glm.radians(a) for a in rot])
         self.scale = scale
 
-        self.program = self.get_program('default')
-        self.vertex_data = self.get_vertex_data('objects/heart/base.obj')
-        self.texture = self.get_texture('objects/heart/texture_diffuse.png')
+        self.morph_paths = MORPH_SETS[HEART_MESH]
+
+        # 'compact' (quantize.py) only for the gpu morph, the other modes write float vertices
+        self.vertex_format = (vertex_format or VERTEX_FORMATS.get(self.mesh_path, 'float')) if morph == 'gpu' else 'float'
+        self.defines = ['COMPACT_VERTICES'] if self.vertex_format == 'compact' else []
+        if morph == 'baked':
+            self.defines = ['BAKED_KEYFRAMES', f'KEYFRAME_COUNT {KEYFRAME_COUNT}']
+        self.program = self.acquire(('program', self.program_name, self.vertex_format, *self.defines),
+                                    lambda: self.get_program(self.program_name))
+        # welded base mesh and morph targets sharing a single index buffer
+        self.indices, self.vertex_data, self.morph_targets = self.acquire(
+            ('mesh', self.mesh_path), lambda: self.get_mesh_data(self.mesh_path, self.morph_paths))
+        # levels of detail: index buffers over subsets of the same vertices
+        lods = self.acquire(('lods', self.mesh_path), lambda: self.get_lods(self.mesh_path, self.morph_paths))
+        self.lod_ibos = [self.acquire(('ibo', self.mesh_path, level), lambda indices=indices: self.ctx.buffer(indices))
+                         for level, indices in enumerate(lods)]
+        self.bounds = self.acquire(('bounds', self.mesh_path), lambda: mesh_bounds(self.vertex_data, self.morph_targets))
+        self.texture = self.acquire(('texture', self.texture_path), lambda: self.get_texture(self.texture_path))
         
-        self.vbo = self.ctx.buffer(self.vertex_data)
         self.format = '2f 3f 3f'
         self.attribs = ['in_texcoord_0', 'in_normal', 'in_position']
-        self.vao = self.ctx.vertex_array(self.program, [(self.vbo, self.format, *self.attribs)])
+
+        # morph 'gpu': the targets are uploaded once and default.vert blends them
+        # morph 'cpu': the hearts sharing the mesh are blended together on the CPU (MorphBatch)
+        #              and only the vertex ranges the targets touch are uploaded every frame
+        # morph 'baked': the beat cycle is baked into keyframes of morph weights, kept in a
+        #               uniform array and played back by phase in default.vert (same buffers as 'gpu')
+        self.morph = morph
+        self.morph_weights = glm.vec3(0.0)
+        # shape of the mesh in the last update_vertex, part of get_state()
+        self.shape_state = None
+        # uniforms that decode the compact vertices, None for float ones
+        self.compact_uniforms = None
+        if self.morph == 'gpu' and self.vertex_format == 'compact':
+            base, targets, self.compact_uniforms = self.acquire(
+                ('compact_mesh', self.mesh_path), lambda: compact_mesh(self.vertex_data, self.morph_targets))
+            self.vbo = self.acquire(('compact_vbo', self.mesh_path), lambda: self.ctx.buffer(base))
+            content = [(self.vbo, COMPACT_FORMAT, *self.attribs)]
+            for i, (path, target) in enumerate(zip(self.morph_paths, targets), start=1):
+                morph_vbo = self.acquire(('compact_morph_vbo', self.mesh_path, path), lambda target=target: self.ctx.buffer(target))
+                content.append((morph_vbo, COMPACT_TARGET_FORMAT, f'in_normal_{i}', f'in_position_{i}'))
+        elif self.morph in ('gpu', 'baked'):
+            # the base mesh is never written, so every heart can draw from the same buffer
+            self.vbo = self.acquire(('vbo', self.mesh_path), lambda: self.ctx.buffer(self.vertex_data))
+            content = [(self.vbo, self.format, *self.attribs)]
+            for i, (path, end_vertices) in enumerate(zip(self.morph_paths, self.morph_targets), start=1):
+                morph_vbo = self.acquire(('morph_vbo', self.mesh_path, path),
+                                         lambda end_vertices=end_vertices: self.ctx.buffer(self.get_morph_target(end_vertices)))
+                content.append((morph_vbo, '3f 3f', f'in_normal_{i}', f'in_position_{i}'))
+        elif self.morph == 'cpu':
+            self.sparse_targets = [
+                self.acquire(('sparse_deltas', self.mesh_path, path), lambda end_vertices=end_vertices: sparse_deltas(self.vertex_data, end_vertices))
+                for path, end_vertices in zip(self.morph_paths, self.morph_targets)]
+            self.batch = self.acquire(('morph_batch', self.mesh_path), lambda: MorphBatch(self.vertex_data, self.sparse_targets))
+            self.batch.add(self)
+            # static texcoords shared by every heart, each one only writes normals and positions
+            texcoord_vbo = self.acquire(('texcoord_vbo', self.mesh_path), lambda: self.ctx.buffer(self.batch.texcoords))
+            self.vbo = self.ctx.buffer(self.batch.base)
+            content = [(texcoord_vbo, '2f', 'in_texcoord_0'), (self.vbo, '3f 3f', 'in_normal', 'in_position')]
+        else:
+            self.vbo = self.ctx.buffer(self.vertex_data)
+            content = [(self.vbo, self.format, *self.attribs)]
+        self.buffers = [buffer for buffer, *_ in content]
+        self.vaos = [self.get_vao(content, ibo) for ibo in self.lod_ibos]
+        self.vao = self.vaos[0]
+        # None: the level follows the projected size, a level number pins it
+        self.fixed_lod = None
 
         self.m_model = self.get_model_matrix()
+        # (pos, rot, scale) the model and normal matrices were last computed for
+        self.model_state = None
         self.camera = self.app.camera
 
         #variables per rotació del cor
@@ -37,21 +134,32 @@ class Heart:
 
         # Animation vertex
         self.start_vertices = self.vertex_data
-        self.end_vertices_step1 = self.get_vertex_data('objects/heart/updated_abaix.obj')
-        self.end_vertices_step2 = self.get_vertex_data('objects/heart/updated_ventricula.obj')
-        self.end_vertices_step3 = self.get_vertex_data('objects/heart/updated_arterias.obj')
+        self.uploaded_bytes = 0  # vertex data written to the GPU so far
+        if self.morph == 'cpu':
+            self.last_morph_weights = glm.vec3(0.0)
+            self.active = set()  # targets to upload at the next flush
+        elif self.morph == 'baked':
+            self.keyframe_key = None
+            self.beat = (0.0, 0.0)  # phase and amplitude of the frame, u_beat
 
         # Animation progress
         self.animation_progress_1 = 0.0
         self.animation_progress_2 = 0.0
         self.animation_progress_3 = 0.0
         self.tempo = 0
+        self.beat_count = 0  # beats since the heart was created, to check the shown rate
+        # weights and phase before the last step, a frame between two steps blends them
+        self.previous_weights = glm.vec3(0.0)
+        self.previous_phase = 0.0
 
         # Animation heart beat
-        self.ppm = ppm
+        self.set_ppm(ppm)
 
         # Animation 
-        self.beat_mask = mask
+        self.set_beat_mask(mask)
+
+        if self.morph == 'baked':
+            self.keyframes = self.get_keyframes()
 
         self.on_init()
             
@@ -78,6 +186,9 @@ class Heart:
 
         # aplicar friccio per parar a la velocitat
         self.rotation_velocity *= self.rotation_friction
+        # parar del tot quan ja no es nota, perque el cor quedi quiet (get_state)
+        if glm.length(self.rotation_velocity) < 1e-3:
+            self.rotation_velocity = glm.vec2(0.0, 0.0)
         
         # actualitzar els angles de rotació radians amb velocitat
         self.rot.y += glm.radians(self.rotation_velocity.x)  # horitzontal
@@ -105,28 +216,64 @@ class Heart:
         m_model = glm.scale(m_model, self.scale)
         return m_model
 
+    def get_vao(self, content, ibo):
+        return self.ctx.vertex_array(self.program, content, index_buffer=ibo,
+                                     index_element_size=self.indices.itemsize)
+
+    def get_bounds(self):
+        # world space bounding sphere (center, radius)
+        center, radius = self.bounds
+        return glm.vec3(self.m_model * glm.vec4(*center, 1.0)), radius * max(self.scale)
+
+    def select_lod(self):
+        # level for the radius in pixels of the bounding sphere in the current viewport
+        if self.fixed_lod is not None:
+            return min(self.fixed_lod, len(self.vaos) - 1)
+        center, radius = self.get_bounds()
+        clip = self.m_proj * self.camera.m_view * glm.vec4(center, 1.0)
+        pixels = radius * self.m_proj[1][1] / max(clip.w, NEAR) * self.ctx.viewport[3] / 2
+        return min(sum(pixels < limit for limit in LOD_PIXELS), len(self.vaos) - 1)
+
+    def acquire(self, key, loader):
+        self.asset_keys.append(key)
+        return self.assets.acquire(key, loader)
+
     def get_vertex_data(self, obj_file):
-        objs = pywavefront.Wavefront(obj_file, parse=True)
-        obj = objs.materials.popitem()[1]
-        vertex_data = obj.vertices
-        vertex_data = np.array(vertex_data, dtype='f4')
-        return vertex_data    
+        # compiled T2F_N3F_V3F array, memory-mapped from objects/.cache
+        return load_mesh(obj_file)
+
+    def get_mesh_data(self, obj_file, morph_files):
+        # (indices, vertices, morph targets) with duplicated vertices welded
+        return load_indexed_mesh(obj_file, morph_files)
+
+    def get_lods(self, obj_file, morph_files):
+        return load_lods(obj_file, morph_files)
+
+    def get_morph_target(self, end_vertices):
+        # normal and position deltas of a morph target against the base mesh (3f 3f)
+        end_vertices = end_vertices.reshape(-1, 8)
+        start_vertices = self.vertex_data.reshape(-1, 8)
+        deltas = end_vertices[:, 2:] - start_vertices[:, 2:]
+        return np.ascontiguousarray(deltas, dtype='f4')
 
     def get_texture(self, path):
-        texture = pg.image.load(path).convert()
-        texture = pg.transform.flip(texture, flip_x=False, flip_y=True)
-        texture = self.ctx.texture(size=texture.get_size(), components=3,
-                                   data=pg.image.tostring(texture, 'RGB'))
+        key = ('texture_data', path)
+        # decoded and flipped once, then read back from the texture cache
+        image = self.assets.prefetched.pop(key) if key in self.assets.prefetched else load_texture(path)
+        return self.upload_texture(image)
+
+    def upload_texture(self, image, max_level=1000):
+        texture = self.ctx.texture(size=image.shape[1::-1], components=3, data=image)
         # mipmaps
         texture.filter = (mgl.LINEAR_MIPMAP_LINEAR, mgl.LINEAR)
-        texture.build_mipmaps()
+        texture.build_mipmaps(max_level=max_level)
         # AF
         texture.anisotropy = 32.0
         return texture
 
     def get_program(self, shader_program_name):
         with open(f'shaders/{shader_program_name}.vert') as file:
-            vertex_shader = file.read()
+            vertex_shader = add_defines(add_includes(file.read()), self.defines)
 
         with open(f'shaders/{shader_program_name}.frag') as file:
             fragment_shader = file.read()
@@ -137,28 +284,66 @@ class Heart:
     def on_init(self):
         # texture
         self.program['u_texture_0'] = 0
-        self.texture.use()
-        # mvp
-        self.program['m_proj'].write(self.camera.m_proj)
-        self.program['m_view'].write(self.camera.m_view)
-        self.program['m_model'].write(self.m_model)
+        # view and projection come from the camera's uniform block
+        self.program[CAMERA_BLOCK].binding = CAMERA_BINDING
+        self.m_proj = glm.mat4(self.camera.m_proj)
         # light
         #self.program['light.position'].write(self.app.light.position)
         self.program['light.Ia'].write(self.app.light.Ia)
         self.program['light.Id'].write(self.app.light.Id)
         self.program['light.Is'].write(self.app.light.Is)
 
+    def write_compact_uniforms(self):
+        # bounds and delta scales of the mesh, for the programs that decode compact vertices
+        for name, value in self.compact_uniforms.items():
+            self.program[name].value = value
+
     def update_animation_params(self, ppm, mask):
+        self.set_ppm(ppm)
+        self.set_beat_mask(mask)
+
+    def set_ppm(self, ppm):
+        # a number is the rate of every beat, a sequence (rhythm.ppm_schedule) the rate of
+        # each beat, read each time the cycle wraps like the beat mask
+        self.ppm_schedule = ppm if hasattr(ppm, '__len__') else None
+        self.set_rate(ppm[0] if self.ppm_schedule is not None else ppm)
+
+    def set_rate(self, ppm):
         self.ppm = ppm
-        self.beat_mask = mask
+        # the mask only scales the baked cycle, a new ppm needs another one (cached, an ECG
+        # or a schedule goes back and forth between a few)
+        if self.morph == 'baked' and self.keyframe_key is not None and self.keyframe_key[0] != round(ppm):
+            self.keyframes = self.get_keyframes()
+            self.shape_state = None
+
+    def set_beat_mask(self, mask):
+        # a sequence repeats, an iterator (rhythm.stream) is read one beat at a time
+        if hasattr(mask, '__len__'):
+            self.beat_mask, self.beat_stream = mask, None
+        else:
+            self.beat_stream = iter(mask)
+            self.beat_mask = [next(self.beat_stream)]
+        self.tempo = 0
 
-    def update_vertex(self, factor_1=0.0167, factor_2=0.0067):
+    def get_keyframes(self):
+        # (KEYFRAME_COUNT + 1, 3) morph weights of a beat, the same for every mesh
+        self.keyframe_key = (round(self.ppm), KEYFRAME_COUNT)
+        return KEYFRAME_CACHE.get(self.keyframe_key, lambda: cycle_weights(self, KEYFRAME_COUNT))
+
+    def update_progress(self, factor_1=1 / SIMULATION_RATE, factor_2=0.0067):
+        # one simulation step: a beat takes 60 / ppm seconds of SIMULATION_RATE steps
         self.animation_progress_1 += (self.ppm * factor_1) / 60
         if self.animation_progress_1 >= 1.0:
-             self.animation_progress_1 = 0.0
+             # the remainder carries over, so beats are not rounded up to whole steps
+             self.animation_progress_1 -= 1.0
+             self.beat_count += 1
              self.tempo += 1
              if self.tempo == len(self.beat_mask):
                 self.tempo = 0
+             if self.beat_stream is not None:
+                self.beat_mask[0] = next(self.beat_stream, self.beat_mask[0])
+             if self.ppm_schedule is not None:
+                self.set_rate(self.ppm_schedule[self.beat_count % len(self.ppm_schedule)])
 
         if self.animation_progress_1 >= 0.5:
             if self.animation_progress_2 < 1.0:
@@ -173,43 +358,132 @@ class Heart:
         else:
             if self.animation_progress_3 > 0.0:
                 self.animation_progress_3 -= (self.ppm * factor_1) / 60
-                
-
-        # Interpolación para cada paso
-        interpolated_vertices_step1 = ((1 - self.animation_progress_1 * self.beat_mask[self.tempo]) * self.start_vertices) + (self.animation_progress_1 * self.beat_mask[self.tempo] * self.end_vertices_step1)
-        interpolated_vertices_step2 = ((1 - self.animation_progress_2 * self.beat_mask[self.tempo]) * self.start_vertices) + (self.animation_progress_2 * self.beat_mask[self.tempo] * self.end_vertices_step2)
-        interpolated_vertices_step3 = ((1 - self.animation_progress_3 * self.beat_mask[self.tempo]) * self.start_vertices) + (self.animation_progress_3 * self.beat_mask[self.tempo] * self.end_vertices_step3)
 
-        # Mezcla ponderada de los pasos
+    def get_morph_weights(self):
+        # the blend below is base + sum(weight_i * (target_i - base)), so each
+        # step reduces to a single weight per morph target
+        amplitude = self.beat_mask[self.tempo]
         blend_factor_step2 = min(self.animation_progress_2 * 2, 1.0)
-        blend_factor_step3 = min(self.animation_progress_3 * 2, 1.0)  
-        p1 = (1 - blend_factor_step2 - blend_factor_step3) * interpolated_vertices_step1
-        p2 = blend_factor_step2 * interpolated_vertices_step2
-        p3 = blend_factor_step3 * interpolated_vertices_step3
-        blended_vertices = p1 + p2 + p3
-
-        # Actualizar los vértices en el modelo
-        self.vbo.write(np.array(blended_vertices, dtype='f4'))
+        blend_factor_step3 = min(self.animation_progress_3 * 2, 1.0)
+        return glm.vec3((1 - blend_factor_step2 - blend_factor_step3) * self.animation_progress_1 * amplitude,
+                        blend_factor_step2 * self.animation_progress_2 * amplitude,
+                        blend_factor_step3 * self.animation_progress_3 * amplitude)
+
+    def step(self, factor_1=1 / SIMULATION_RATE, factor_2=0.0067):
+        # advance the animation one simulation step, the mesh follows in update_mesh
+        self.previous_weights = self.get_morph_weights()
+        self.previous_phase = self.animation_progress_1
+        self.update_progress(factor_1, factor_2)
+
+    def get_frame_weights(self, alpha=1.0):
+        # morph weights alpha of the way from the previous step to the current one
+        weights = self.get_morph_weights()
+        return glm.mix(self.previous_weights, weights, alpha) if alpha < 1.0 else weights
+
+    def update_vertex(self, factor_1=1 / SIMULATION_RATE, factor_2=0.0067):
+        self.step(factor_1, factor_2)
+        self.update_mesh()
+
+    def update_mesh(self, alpha=1.0):
+        # the mesh for a frame alpha of the way between the last two steps
+        if self.morph == 'gpu':
+            # only the weights go to the GPU, the mesh stays untouched
+            self.morph_weights = self.get_frame_weights(alpha)
+            self.shape_state = tuple(w if abs(w) > 1e-6 else 0.0 for w in self.morph_weights)
+            return
+        if self.morph == 'baked':
+            self.update_keyframe_vertex(alpha)
+            return
+
+        # only the targets with a weight now or in the last frame touch the mesh
+        # (the progress counters ramp down to ~1e-17 rather than 0, hence the epsilon)
+        weights = self.get_frame_weights(alpha)
+        weights = glm.vec3([w if abs(w) > 1e-6 else 0.0 for w in weights])
+        active = [i for i in range(3) if weights[i] != 0.0 or self.last_morph_weights[i] != 0.0]
+        self.last_morph_weights = weights
+        self.shape_state = tuple(weights)
+        if active:
+            # blended and uploaded with the other hearts of the batch before the next draw
+            self.active.update(active)
+            self.batch.pending = True
+
+    def upload_blended(self, blended):
+        # normals and positions (vertices, 6) the batch blended for this heart
+        if not self.active:
+            return
+        ranges = self.batch.upload_ranges[tuple(sorted(self.active))]
+        self.active.clear()
+        with self.app.profiler.stage('upload'):
+            for start, end in ranges:
+                self.vbo.write(blended[start:end], offset=start * blended.strides[0])
+                self.uploaded_bytes += (end - start) * blended.strides[0]
+
+    def update_keyframe_vertex(self, alpha=1.0):
+        # phase of the frame and amplitude of the beat: default.vert blends the morph targets
+        # with amplitude * lerp(previous keyframe, next keyframe)
+        amplitude = self.beat_mask[self.tempo]
+        phase = self.animation_progress_1
+        if alpha < 1.0:
+            phase = (self.previous_phase + (phase - self.previous_phase) % 1.0 * alpha) % 1.0
+        # a skipped beat leaves the base mesh whatever the phase
+        self.beat = (phase, amplitude) if abs(amplitude) > 1e-6 else (0.0, 0.0)
+        self.shape_state = self.beat
+
+    def get_state(self):
+        # everything the heart's picture depends on: equal in two frames that draw the same
+        return tuple(self.pos), tuple(self.rot), tuple(self.scale), getattr(self, 'rotation_y', 0.0), self.shape_state
+
+    def changed(self, key, state):
+        # whether shared GL state needs writing: another heart wrote it last or the value changed
+        if self.assets.sent.get(key) == state:
+            return False
+        self.assets.sent[key] = state
+        return True
 
     def update(self):
-        self.texture.use()
-        self.program['camPos'].write(self.camera.position)
-        self.program['m_view'].write(self.camera.m_view)
-        self.m_model = self.get_model_matrix()  # Recalculate model matrix
-        self.program['m_model'].write(self.m_model)
-        
+        if self.morph == 'cpu':
+            self.batch.flush()
+        if self.changed(('texture', 0), self.texture):
+            self.texture.use()
+        state = (tuple(self.pos), tuple(self.rot), tuple(self.scale), getattr(self, 'rotation_y', 0.0))
+        if state != self.model_state:
+            self.model_state = state
+            self.m_model = self.get_model_matrix()  # Recalculate model matrix
+            self.m_normal = glm.transpose(glm.inverse(glm.mat3(self.m_model)))
+        if self.compact_uniforms and self.changed((self.program, 'compact'), self.mesh_path):
+            self.write_compact_uniforms()
+        if self.changed((self.program, 'm_model'), (self, state)):
+            self.program['m_model'].write(self.m_model)
+            self.program['m_normal'].write(self.m_normal)
+        if self.morph == 'baked':
+            if self.changed((self.program, 'u_keyframes'), self.keyframe_key):
+                self.program['u_keyframes'].write(self.keyframes)
+            if self.changed((self.program, 'u_beat'), (self, self.beat)):
+                self.program['u_beat'].value = self.beat
+        elif self.changed((self.program, 'u_morph'), (self, glm.vec3(self.morph_weights))):
+            self.program['u_morph'].write(self.morph_weights)
+
     def render(self):
         self.update()
+        self.vao = self.vaos[self.select_lod()]
         self.vao.render()
 
-    def animate(self):
-        self.update_vertex()
-        self.update_rotation() 
+    def animate(self, alpha=1.0):
+        # once per frame, after the simulation steps of the frame
+        self.update_mesh(alpha)
+        if self.app.interactive:
+            self.update_rotation()
 
     def destroy(self):
-        self.vbo.release()
-        self.texture.release()
-        self.program.release()
+        if self.morph == 'cpu':
+            self.batch.remove(self)
+        for vao in self.vaos:
+            vao.release()
+        if self.morph not in ('gpu', 'baked'):
+            self.vbo.release()
+        for key in self.asset_keys:
+            self.assets.release(key)
+        self.asset_keys.clear()
 
         
     
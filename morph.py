@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+import numpy as np
+from mesh_cache import dirty_ranges
+
+# vertices between two moving runs that are blended anyway to merge them, a numpy call per
+# run costs about as much as blending a few hundred vertices
+BLEND_GAP = 256
+
+# CPU morphing of every heart that shares a mesh in one batch: the normals and positions
+# of all the hearts are one (hearts, vertices, 6) array, and a frame only blends the targets
+# some heart has active, over the vertices they move, as base + weights @ deltas with
+# matmul/add into preallocated buffers; the texcoords never change and stay in their own
+# static buffer
+
+
+class MorphBatch:
+    workers = 1  # default threads splitting the hearts between them, numpy releases the GIL in matmul/add
+
+    def __init__(self, vertex_data, sparse_targets, workers=None):
+        vertices = np.asarray(vertex_data).reshape(-1, 8)
+        self.texcoords = np.ascontiguousarray(vertices[:, :2], dtype='f4')
+        self.base = np.ascontiguousarray(vertices[:, 2:], dtype='f4')
+        self.targets = sparse_targets
+        # vertex ranges covering what every set of active targets moves, to blend and to upload
+        self.blend_ranges = {}
+        self.upload_ranges = {}
+        for count in range(1, len(sparse_targets) + 1):
+            for active in combinations(range(len(sparse_targets)), count):
+                indices = np.unique(np.concatenate([sparse_targets[i][0] for i in active]))
+                self.blend_ranges[active] = dirty_ranges(indices, BLEND_GAP)
+                self.upload_ranges[active] = dirty_ranges(indices)
+        # active targets -> (start, end, the targets' deltas over the range (targets, vertices * 6))
+        # of each of their ranges, built on first use
+        self.subsets = {}
+        self.workers = workers or MorphBatch.workers
+        self.pool = None
+        self.hearts = []
+        self.pending = False  # some heart changed its weights since the last flush
+        self.resize()
+
+    def resize(self):
+        self.weights = np.zeros((len(self.hearts), len(self.targets)), dtype='f4')
+        # vertices no target moves keep the base, only the moving ones are written after this
+        self.blended = np.empty((len(self.hearts), *self.base.shape), dtype='f4')
+        self.blended[:] = self.base
+
+    def add(self, heart):
+        self.hearts.append(heart)
+        self.resize()
+
+    def remove(self, heart):
+        self.hearts.remove(heart)
+        self.resize()
+
+    def get_subset(self, active):
+        subset = self.subsets.get(active)
+        if subset is None:
+            subset = self.subsets[active] = []
+            for start, end in self.blend_ranges[active]:
+                deltas = np.zeros((len(active), end - start, 6), dtype='f4')
+                for delta, i in zip(deltas, active):
+                    indices, values = self.targets[i]
+                    inside = (indices >= start) & (indices < end)
+                    delta[indices[inside] - start] = values[inside]
+                subset.append((start, end, deltas.reshape(len(active), -1)))
+        return subset
+
+    def blend(self, subset, weights, first, last):
+        # straight into the ranges of the hearts' rows, the rest of the rows keeps the base
+        rows = self.blended[first:last].reshape(last - first, -1)
+        base = self.base.reshape(-1)
+        weights = weights[first:last]
+        for start, end, deltas in subset:
+            blended = rows[:, start * 6:end * 6]
+            if len(deltas) == 1:
+                # numpy's matmul over a single target is several times slower than the product
+                np.multiply(weights, deltas, out=blended)
+            else:
+                np.matmul(weights, deltas, out=blended)
+            np.add(blended, base[start * 6:end * 6], out=blended)
+
+    def flush(self):
+        # blend every heart and upload what each one changed, once per frame however many
+        # views draw it
+        if not self.pending:
+            return
+        self.pending = False
+        active = tuple(sorted(set().union(*[heart.active for heart in self.hearts])))
+        if not active:
+            return
+        for row, heart in enumerate(self.hearts):
+            self.weights[row] = heart.last_morph_weights
+        subset = self.get_subset(active)
+        # targets no heart has active weigh 0 for every heart and are left out
+        weights = self.weights[:, active]
+        count = len(self.hearts)
+        workers = min(self.workers, count)
+        if workers > 1:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            bounds = np.linspace(0, count, workers + 1).astype(int).tolist()
+            for job in [self.pool.submit(self.blend, subset, weights, first, last)
+                        for first, last in zip(bounds[:-1], bounds[1:])]:
+                job.result()
+        else:
+            self.blend(subset, weights, 0, count)
+        for row, heart in enumerate(self.hearts):
+            heart.upload_blended(self.blended[row])
+
+    def release(self):
+        # freed by the asset registry with the last heart of the mesh
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
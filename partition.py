@@ -0,0 +1,129 @@
+import hashlib
+import os
+import numpy as np
+from mesh_cache import MORPH_SETS, SPARSE_TOLERANCE, cache_path, load_indexed_mesh, load_mesh, source_hash, store, weld
+from model import HEART_MESH, Heart
+from texture_cache import ATLAS_LEVELS, ATLAS_PADDING, ATLAS_WIDTH, atlas_layout, atlas_texcoords, load_atlas, load_texture
+
+PARTITION_DIR = 'objects/heart_partition'
+# the regions of the heart, in the order of the morph targets (animation steps) that move them
+REGION_MESHES = [f'{PARTITION_DIR}/baseabaix.obj',
+                 f'{PARTITION_DIR}/baseventricula.obj',
+                 f'{PARTITION_DIR}/basearterias.obj']
+REGION_NAMES = ['abaix', 'ventricula', 'arterias']
+REGION_TEXTURES = [f'{PARTITION_DIR}/texture_abaix.png',
+                   f'{PARTITION_DIR}/texture_ventricula.png',
+                   f'{PARTITION_DIR}/texture_arterias.png']
+# the region textures packed side by side, each region's uvs point into its own part
+ATLAS_PATH = f'{PARTITION_DIR}/atlas'
+
+
+def vertex_keys(rows):
+    return np.ascontiguousarray(rows).view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+
+def match_vertices(rows, reference):
+    # index in reference of a vertex with the same key as each row, -1 when there is none
+    _, inverse = np.unique(np.concatenate([vertex_keys(reference), vertex_keys(rows)]), return_inverse=True)
+    inverse = inverse.ravel()
+    table = np.full(inverse.max() + 1, -1)
+    table[inverse[:len(reference)]] = np.arange(len(reference))
+    return table[inverse[len(reference):]]
+
+
+def partition_mesh(path, target_paths, region_paths, texture_paths):
+    # the region meshes welded and stacked in one vertex array, with morph targets moved
+    # over from the monolithic mesh (the regions cut its faces, so every region vertex
+    # has a base vertex at the same point, and most with the same normal too) and uvs
+    # moved into the region's texture in the atlas
+    _, vertex_data, targets = load_indexed_mesh(path, target_paths)
+    sizes = [load_texture(texture_path).shape[1::-1] for texture_path in texture_paths]
+    atlas_size, offsets = atlas_layout(sizes)
+    base = np.asarray(vertex_data).reshape(-1, 8)
+    deltas = [np.asarray(target).reshape(-1, 8)[:, 2:] - base[:, 2:] for target in targets]
+    all_indices, all_vertices, regions = [], [], []
+    first_vertex = first_index = 0
+    for region_path, size, offset in zip(region_paths, sizes, offsets):
+        indices, (region,) = weld([load_mesh(region_path)])
+        region = region.reshape(-1, 8)
+        match = match_vertices(region[:, 2:], base[:, 2:])
+        by_point = match_vertices(region[:, 5:], base[:, 5:])
+        match[match < 0] = by_point[match < 0]
+        # vertices moved by the same targets kept together: the targets of the other
+        # regions only move a border strip, which then uploads as a single range
+        moved_by = sum((np.abs(delta[match]).max(axis=1) > SPARSE_TOLERANCE) << i for i, delta in enumerate(deltas))
+        order = np.argsort(moved_by, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        all_indices.append(rank[indices] + first_vertex)
+        all_vertices.append((region[order], match[order]))
+        regions.append((first_vertex, len(region), first_index, len(indices)))
+        first_vertex += len(region)
+        first_index += len(indices)
+
+    vertices = np.vstack([region for region, _ in all_vertices])
+    match = np.concatenate([match for _, match in all_vertices])
+    meshes = [vertices]
+    # after matching, the base mesh has the original uvs
+    first_vertex = 0
+    for size, offset, (_, count, _, _) in zip(sizes, offsets, regions):
+        texcoords = vertices[first_vertex:first_vertex + count, :2]
+        texcoords[:] = atlas_texcoords(texcoords, size, offset, atlas_size)
+        first_vertex += count
+    for delta in deltas:
+        target = vertices.copy()
+        target[:, 2:] += delta[match]
+        meshes.append(target)
+    indices = np.concatenate(all_indices).astype('u2' if first_vertex < 2 ** 16 else 'u4')
+    return indices, [mesh.reshape(-1) for mesh in meshes], np.array(regions, dtype='i8')
+
+
+def load_partitioned_mesh(path=HEART_MESH, target_paths=MORPH_SETS[HEART_MESH], region_paths=REGION_MESHES,
+                          texture_paths=REGION_TEXTURES):
+    # (indices, vertices, targets, regions) cached like load_indexed_mesh; regions has a
+    # (first vertex, vertex count, first index, index count) row per region
+    paths = [path, *target_paths, *region_paths, *texture_paths]
+    key = ''.join(source_hash(p) for p in paths) + repr((ATLAS_WIDTH, ATLAS_PADDING))
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    cached = [cache_path(PARTITION_DIR, digest).replace('.npy', f'.{part}.npy')
+              for part in ['indices', 'regions', *range(len(target_paths) + 1)]]
+    if not all(os.path.exists(name) for name in cached):
+        indices, meshes, regions = partition_mesh(path, target_paths, region_paths, texture_paths)
+        for name, array in zip(cached, [indices, regions, *meshes]):
+            store(name, array, depth=2)
+    indices, regions, *meshes = [np.load(name, mmap_mode='r') for name in cached]
+    return indices, meshes[0], meshes[1:], np.array(regions)
+
+
+class PartitionedHeart(Heart):
+    # the heart as separate regions in one shared buffer, their textures packed in one
+    # atlas; morphed on the CPU, so each animation step only rewrites the region it
+    # moves, and drawn with one multi-draw call over all the regions
+    mesh_path = PARTITION_DIR
+    texture_path = ATLAS_PATH
+
+    def __init__(self, app, pos=(0, 0, 0), rot=(0, 0, 0), scale=(1, 1, 1), ppm=60, mask=[1], assets=None):
+        super().__init__(app, pos, rot, scale, ppm, mask, morph='cpu', assets=assets)
+        self.regions = self.acquire(('regions', self.mesh_path), lambda: load_partitioned_mesh(HEART_MESH, self.morph_paths)[3])
+        # DrawElementsIndirectCommand per region: count, instances, first index, base vertex, base instance
+        commands = [(index_count, 1, first_index, 0, 0) for _, _, first_index, index_count in self.regions]
+        self.indirect = self.acquire(('indirect', self.mesh_path), lambda: self.ctx.buffer(np.array(commands, dtype='u4')))
+
+    def get_mesh_data(self, obj_file, morph_files):
+        return load_partitioned_mesh(HEART_MESH, morph_files)[:3]
+
+    def get_lods(self, obj_file, morph_files):
+        # the regions are not decimated
+        return [self.indices]
+
+    def get_texture(self, path):
+        return self.upload_texture(load_atlas(REGION_TEXTURES, path), max_level=ATLAS_LEVELS)
+
+    def render(self):
+        self.update()
+        if self.ctx.version_code >= 430:
+            self.vao.render_indirect(self.indirect, count=len(self.regions))
+        else:
+            # no glMultiDrawElementsIndirect before GL 4.3, one draw per region
+            for _, _, first_index, index_count in self.regions:
+                self.vao.render(vertices=int(index_count), first=int(first_index))
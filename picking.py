@@ -0,0 +1,196 @@
+import copy
+import numpy as np
+import glm
+from mesh_cache import MORPH_SETS
+from model import HEART_MESH
+from partition import REGION_NAMES, load_partitioned_mesh
+from ward import HeartWard
+
+# ray picking of the heart under the mouse: the partitioned heart (same surface as the
+# monolithic one, with a region per triangle) in a bounding volume hierarchy that each heart
+# refits to its own morph, and rays traced through it a whole tree level at a time
+
+# triangles per leaf of the hierarchy
+LEAF_SIZE = 8
+
+
+class TriangleBVH:
+    # implicit binary tree over the triangles: level l has 2**l nodes, the children of node
+    # i are 2i and 2i + 1, and a leaf holds up to leaf_size consecutive triangles of order
+    def __init__(self, positions, triangles, leaf_size=LEAF_SIZE):
+        centroids = positions[triangles].mean(axis=1)
+        count = len(triangles)
+        self.depth = max(0, int(np.ceil(np.log2(count / leaf_size))))
+        # median split of every node along the longest side of its centroids, one level at
+        # a time: sorting by (node, coordinate) orders all the nodes of the level at once
+        order = np.arange(count)
+        for level in range(self.depth):
+            bounds = self.level_bounds(count, level)
+            node = np.repeat(np.arange(2 ** level), np.diff(bounds))
+            points = centroids[order]
+            extent = np.maximum.reduceat(points, bounds[:-1]) - np.minimum.reduceat(points, bounds[:-1])
+            key = points[np.arange(count), np.argmax(extent, axis=1)[node]]
+            order = order[np.lexsort((key, node))]
+        self.order = order
+        self.triangles = np.asarray(triangles)[order]
+        bounds = self.level_bounds(count, self.depth)
+        self.leaf_starts, self.leaf_counts = bounds[:-1], np.diff(bounds)
+        self.refit(positions)
+
+    @staticmethod
+    def level_bounds(count, level):
+        # first triangle of each node of a level (and count), the halves of the level above
+        return (np.arange(2 ** level + 1) * count) >> level
+
+    def refit(self, positions):
+        # node boxes for new vertex positions, same tree; new arrays, so copies of a
+        # hierarchy refit on their own
+        corners = positions[self.triangles]
+        self.v0 = corners[:, 0]
+        self.e1 = corners[:, 1] - corners[:, 0]
+        self.e2 = corners[:, 2] - corners[:, 0]
+        lower = [np.minimum.reduceat(corners.min(axis=1), self.leaf_starts)]
+        upper = [np.maximum.reduceat(corners.max(axis=1), self.leaf_starts)]
+        for _ in range(self.depth):
+            lower.insert(0, np.minimum(lower[0][0::2], lower[0][1::2]))
+            upper.insert(0, np.maximum(upper[0][0::2], upper[0][1::2]))
+        self.lower, self.upper = lower, upper
+
+    def intersect(self, origins, directions):
+        # (t, triangle) of the nearest hit of each ray origin + t * direction (t >= 0),
+        # inf and -1 where a ray misses; triangles are numbered as given to the build
+        origins, directions = np.asarray(origins, dtype='f4'), np.asarray(directions, dtype='f4')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse = 1 / directions
+            # (ray, node) pairs whose box the ray goes through, level by level
+            rays = np.arange(len(origins))
+            nodes = np.zeros(len(origins), dtype=int)
+            for level in range(self.depth + 1):
+                if level:
+                    rays = np.repeat(rays, 2)
+                    nodes = np.column_stack([2 * nodes, 2 * nodes + 1]).ravel()
+                t1 = (self.lower[level][nodes] - origins[rays]) * inverse[rays]
+                t2 = (self.upper[level][nodes] - origins[rays]) * inverse[rays]
+                near = np.fmin(t1, t2).max(axis=1)
+                far = np.fmax(t1, t2).min(axis=1)
+                hit = (near <= far) & (far >= 0)
+                rays, nodes = rays[hit], nodes[hit]
+            # every triangle of the leaves hit, Moller-Trumbore
+            counts = self.leaf_counts[nodes]
+            rays = np.repeat(rays, counts)
+            triangles = np.repeat(self.leaf_starts[nodes] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            d, e1, e2 = directions[rays], self.e1[triangles], self.e2[triangles]
+            p = np.cross(d, e2)
+            det = np.einsum('ij,ij->i', e1, p)
+            s = origins[rays] - self.v0[triangles]
+            u = np.einsum('ij,ij->i', s, p) / det
+            q = np.cross(s, e1)
+            v = np.einsum('ij,ij->i', d, q) / det
+            t = np.einsum('ij,ij->i', e2, q) / det
+            hit = (np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+        rays, triangles, t = rays[hit], triangles[hit], t[hit]
+        # nearest hit of each ray
+        nearest = np.lexsort((t, rays))
+        first = nearest[np.flatnonzero(np.diff(rays[nearest], prepend=-1))]
+        distance = np.full(len(origins), np.inf)
+        hits = np.full(len(origins), -1)
+        distance[rays[first]] = t[first]
+        hits[rays[first]] = self.order[triangles[first]]
+        return distance, hits
+
+
+class PickMesh:
+    # the partitioned heart with the position deltas of its morph targets and the region
+    # of every triangle, and the hierarchy built over it at rest
+    def __init__(self, path=HEART_MESH, target_paths=MORPH_SETS[HEART_MESH]):
+        indices, vertex_data, targets, regions = load_partitioned_mesh(path, target_paths)
+        self.base = np.asarray(vertex_data, dtype='f4').reshape(-1, 8)[:, 5:]
+        self.deltas = np.stack([np.asarray(target, dtype='f4').reshape(-1, 8)[:, 5:] - self.base for target in targets])
+        self.triangles = np.asarray(indices, dtype='i8').reshape(-1, 3)
+        self.regions = np.repeat(np.arange(len(regions)), regions[:, 3] // 3)
+        self.bvh = TriangleBVH(self.base, self.triangles)
+
+    def positions(self, weights):
+        return self.base + np.tensordot(np.asarray(weights, dtype='f4'), self.deltas, axes=1)
+
+
+class HeartPicker:
+    # the heart, region and surface point under a pixel of the window
+    def __init__(self, app):
+        self.app = app
+        self.mesh = None  # built on the first pick
+        # heart, or (ward, patient) -> [hierarchy refit to its shape, morph weights of the refit]
+        self.bvhs = {}
+
+    def clear(self):
+        # the scene's hearts were replaced
+        self.bvhs.clear()
+
+    def get_bvh(self, key, weights):
+        if self.mesh is None:
+            self.mesh = PickMesh()
+        entry = self.bvhs.get(key)
+        if entry is None:
+            entry = self.bvhs[key] = [copy.copy(self.mesh.bvh), None]
+        # refit only when the weights moved
+        weights = tuple(float(weight) for weight in weights)
+        if weights != entry[1]:
+            entry[0].refit(self.mesh.positions(weights))
+            entry[1] = weights
+        return entry[0]
+
+    def get_instances(self, heart, alpha=1.0):
+        # (patient, model matrix, morph weights) of every heart the object draws, as in the
+        # frame on screen: a single heart alpha of the way between its last two steps, every
+        # patient of a ward with the matrix and the weights of its instance (patient None: a
+        # single heart)
+        if isinstance(heart, HeartWard):
+            # instance matrices are column-major like glm's constructor takes them
+            matrices = heart.instance_data[:, :16]
+            return [(i, glm.mat4(*matrices[i].tolist()), heart.frame_weights[i]) for i in range(heart.count)]
+        return [(None, heart.get_model_matrix(), heart.get_frame_weights(alpha))]
+
+    def get_ray(self, pixel):
+        # world space ray through a window pixel (top-left origin), None outside every view
+        x, y = pixel[0], self.app.WIN_SIZE[1] - pixel[1]
+        for _, (left, bottom, width, height), view in self.app.get_views():
+            if left <= x < left + width and bottom <= y < bottom + height:
+                return self.app.camera.get_ray(view, 2 * (x - left + 0.5) / width - 1, 2 * (y - bottom + 0.5) / height - 1)
+        return None
+
+    def pick(self, pixel, alpha=1.0):
+        # (heart, region name, world point, ward patient or None) of the nearest heart surface
+        # under pixel, or None, with the hearts as drawn in a frame alpha of the way between
+        # the last two steps
+        ray = self.get_ray(pixel)
+        if ray is None:
+            return None
+        origin, direction = ray
+        best = None
+        for heart in self.app.scene.objects:
+            center, radius = heart.bounds
+            center = glm.vec3(*center)
+            for patient, model, weights in self.get_instances(heart, alpha):
+                # into the mesh's space: the ray parameter t stays the same as in world space
+                inverse = glm.inverse(model)
+                local_origin, local_direction = (inverse * glm.vec4(origin, 1.0)).xyz, (inverse * glm.vec4(direction, 0.0)).xyz
+                # the mesh's bounding sphere holds it in every morph, only the hearts whose
+                # sphere the ray goes through are refit and traced (most patients of a ward)
+                closest = local_origin + max(glm.dot(center - local_origin, local_direction), 0.0) \
+                    / glm.dot(local_direction, local_direction) * local_direction
+                if glm.distance(closest, center) > radius:
+                    continue
+                key = heart if patient is None else (heart, patient)
+                distance, triangles = self.get_bvh(key, weights).intersect([tuple(local_origin)], [tuple(local_direction)])
+                if triangles[0] >= 0 and (best is None or distance[0] < best[0]):
+                    best = (distance[0], heart, patient, triangles[0])
+        if best is None:
+            return None
+        distance, heart, patient, triangle = best
+        return heart, REGION_NAMES[self.mesh.regions[triangle]], origin + float(distance) * direction, patient
+
+    def describe(self, picked):
+        # one line for the log and the HUD
+        heart, region, point, patient = picked
+        name = f'heart {self.app.scene.objects.index(heart)}' if patient is None else f'patient {patient}'
+        return f'{name}: {region} at ({point.x:.3f}, {point.y:.3f}, {point.z:.3f})'
@@ -0,0 +1,195 @@
+import csv
+import time
+from collections import deque
+from contextlib import nullcontext
+import moderngl as mgl
+import numpy as np
+import pygame as pg
+
+# shared no-op returned by stage() and gpu() while profiling is off
+NULL_STAGE = nullcontext()
+
+
+class Stage:
+    # adds the wall time of a with block to record[name], in milliseconds
+    __slots__ = ('record', 'name', 'start')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = (time.perf_counter() - self.start) * 1000
+        self.record[self.name] = self.record.get(self.name, 0.0) + elapsed
+
+
+class FrameProfiler:
+    # per-frame CPU stage timers and GPU timer queries, kept in a ring buffer of the
+    # last frames and optionally streamed to CSV (frame, stage, ms)
+    def __init__(self, ctx, size=300, csv_path=None):
+        self.ctx = ctx
+        self.frames = deque(maxlen=size)
+        self.enabled = False
+        self.frame = 0
+        self.record = {}
+        self.first_frame_ms = None  # launcher click to the first frame of the scene, if launched from it
+        # two queries per name, one being filled while the other one of the last frame is read
+        self.queries = {}
+        self.pending = []
+        self.csv_file = None
+        self.csv = None
+        if csv_path:
+            self.stream(csv_path)
+
+    def stream(self, csv_path):
+        self.csv_file = open(csv_path, 'w', newline='')
+        self.csv = csv.writer(self.csv_file)
+        self.csv.writerow(['frame', 'stage', 'ms'])
+        self.enabled = True
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self.record, name)
+
+    def gpu(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        queries = self.queries.get(name)
+        if queries is None:
+            queries = self.queries[name] = [self.ctx.query(time=True), self.ctx.query(time=True)]
+        query = queries[self.frame % 2]
+        self.pending.append((self.frame, self.record, f'gpu {name}', query))
+        return query
+
+    def first_frame(self, ms):
+        # kept for the HUD and streamed as its own row, whether or not frames are being recorded
+        self.first_frame_ms = ms
+        if self.csv is not None:
+            self.csv.writerow([self.frame, 'first frame', f'{ms:.4f}'])
+
+    def begin_frame(self):
+        if self.enabled:
+            self.record = {'start': time.perf_counter()}
+
+    def end_frame(self):
+        record = self.record
+        if not self.enabled or 'start' not in record:
+            # off, or switched on (F3) after begin_frame: recording starts with the next frame
+            self.pending = [entry for entry in self.pending if entry[1] is not record]
+            self.record = {}
+            return
+        record['frame'] = (time.perf_counter() - record.pop('start')) * 1000
+        self.frames.append(record)
+        # GPU results of the previous frame are ready by now, this frame's are left for the next
+        pending, self.pending = self.pending, []
+        for frame, frame_record, name, query in pending:
+            if frame == self.frame:
+                self.pending.append((frame, frame_record, name, query))
+            else:
+                frame_record[name] = frame_record.get(name, 0.0) + query.elapsed / 1e6
+                self.write_row(frame, frame_record)
+        self.frame += 1
+        self.record = {}
+
+    def write_row(self, frame, record):
+        if self.csv is None or record.get('written'):
+            return
+        record['written'] = True
+        for name, ms in record.items():
+            if name != 'written':
+                self.csv.writerow([frame, name, f'{ms:.4f}'])
+
+    def averages(self):
+        # mean ms of every stage over the ring buffer
+        totals = {}
+        for record in self.frames:
+            for name, ms in record.items():
+                if name != 'written':
+                    totals[name] = totals.get(name, 0.0) + ms
+        return {name: total / len(self.frames) for name, total in totals.items()}
+
+    def destroy(self):
+        if self.csv_file:
+            self.csv_file.close()
+        # moderngl queries have no release(), they go away with the context
+        self.queries.clear()
+
+
+class ProfilerHud:
+    # text overlay with the profiler averages, drawn on top of the scene
+    def __init__(self, app, profiler, refresh=15):
+        self.app = app
+        self.ctx = app.ctx
+        self.profiler = profiler
+        self.refresh = refresh  # frames between text updates
+        self.visible = False
+        self.font = pg.font.SysFont('dejavusansmono,couriernew,monospace', 15)
+        with open('shaders/hud.vert') as file:
+            vertex_shader = file.read()
+        with open('shaders/hud.frag') as file:
+            fragment_shader = file.read()
+        self.program = self.ctx.program(vertex_shader=vertex_shader, fragment_shader=fragment_shader)
+        # unit 1: unit 0 keeps the hearts' texture bound between frames
+        self.program['u_texture_0'] = 1
+        quad = np.array([0, 0, 1, 0, 0, 1, 1, 1], dtype='f4')
+        self.vbo = self.ctx.buffer(quad)
+        self.vao = self.ctx.vertex_array(self.program, [(self.vbo, '2f', 'in_position')])
+        self.texture = None
+        self.texture_dirty = False  # redraw the text before the next refresh
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.profiler.enabled = self.visible or self.profiler.csv is not None
+
+    def update_texture(self):
+        averages = self.profiler.averages()
+        frame = averages.pop('frame', 0.0)
+        lines = [f'frame {frame:6.2f} ms ({1000 / frame if frame else 0:5.1f} fps)']
+        lines += [f'{name:<28}{ms:8.3f} ms' for name, ms in sorted(averages.items())]
+        if self.profiler.first_frame_ms is not None:
+            lines.append(f'{"first frame":<28}{self.profiler.first_frame_ms:8.0f} ms')
+        # the last left click of the window, if it has a picker
+        picked = getattr(self.app, 'picked', None)
+        if picked:
+            lines.append(self.app.picker.describe(picked))
+        rendered = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+        width = max(text.get_width() for text in rendered) + 16
+        height = sum(text.get_height() for text in rendered) + 16
+        surface = pg.Surface((width, height), pg.SRCALPHA)
+        surface.fill((0, 0, 0, 160))
+        y = 8
+        for text in rendered:
+            surface.blit(text, (8, y))
+            y += text.get_height()
+        if self.texture:
+            self.texture.release()
+        self.texture = self.ctx.texture(surface.get_size(), 4, pg.image.tostring(surface, 'RGBA', True))
+
+    def render(self):
+        if not self.visible or not self.profiler.frames:
+            return
+        if self.texture is None or self.texture_dirty or self.profiler.frame % self.refresh == 0:
+            self.update_texture()
+            self.texture_dirty = False
+        win_w, win_h = self.app.WIN_SIZE
+        width, height = self.texture.size
+        self.ctx.viewport = (0, 0, win_w, win_h)
+        # top-left corner in normalized device coordinates
+        self.program['u_rect'] = (-1 + 32 / win_w, 1 - (16 + height) * 2 / win_h, width * 2 / win_w, height * 2 / win_h)
+        self.ctx.disable(mgl.DEPTH_TEST | mgl.CULL_FACE)
+        self.ctx.enable(mgl.BLEND)
+        self.texture.use(location=1)
+        self.vao.render(mgl.TRIANGLE_STRIP)
+        self.ctx.disable(mgl.BLEND)
+        self.ctx.enable(mgl.DEPTH_TEST | mgl.CULL_FACE)
+
+    def destroy(self):
+        if self.texture:
+            self.texture.release()
+        self.vao.release()
+        self.vbo.release()
+        self.program.release()
@@ -0,0 +1,100 @@
+import sys
+import numpy as np
+from mesh_cache import MORPH_SETS, load_indexed_mesh
+
+# compact vertex format, decoded in default.vert/ward.vert when COMPACT_VERTICES is defined:
+# uv and position as uint16 over their bounds, normal as octahedral int16 and every morph
+# target as its normal delta in int8 and position delta in int16, each scaled by the
+# target's largest delta per axis; 16 + 12 bytes per target instead of 32 + 24
+COMPACT_FORMAT = '2u2 2i2 3u2 x2'
+COMPACT_TARGET_FORMAT = '3i1 x1 3i2 x2'
+COMPACT_DTYPE = np.dtype([('uv', '<u2', 2), ('normal', '<i2', 2), ('position', '<u2', 3), ('pad', '<u2')])
+COMPACT_TARGET_DTYPE = np.dtype([('normal', 'i1', 3), ('pad', 'i1'), ('position', '<i2', 3), ('pad_2', '<i2')])
+
+
+def unorm_bounds(values):
+    # (offset, scale) mapping uint16 0..65535 to the range of values, per column
+    low, high = values.min(axis=0), values.max(axis=0)
+    return low, np.maximum(high - low, 1e-12) / 65535
+
+
+def octahedral(normals):
+    # unit normals folded onto the octahedron and flattened to [-1, 1]^2
+    n = normals / np.abs(normals).sum(axis=1, keepdims=True)
+    xy = n[:, :2].copy()
+    back = n[:, 2] < 0
+    sign = np.where(xy[back] >= 0, 1.0, -1.0)
+    xy[back] = (1 - np.abs(xy[back][:, ::-1])) * sign
+    return xy
+
+
+def decode_octahedral(xy):
+    # morph_vertex.glsl's octahedral()
+    n = np.column_stack([xy, 1 - np.abs(xy).sum(axis=1)])
+    back = n[:, 2] < 0
+    sign = np.where(n[back, :2] >= 0, 1.0, -1.0)
+    n[back, :2] = (1 - np.abs(n[back][:, 1::-1])) * sign
+    return n / np.linalg.norm(n, axis=1, keepdims=True)
+
+
+def compact_mesh(vertex_data, targets):
+    # (base rows, target rows, uniforms to decode them) for a T2F_N3F_V3F mesh and its targets
+    vertices = np.asarray(vertex_data, dtype='f8').reshape(-1, 8)
+    uniforms = {}
+    base = np.zeros(len(vertices), dtype=COMPACT_DTYPE)
+    for name, values in [('texcoord', vertices[:, :2]), ('position', vertices[:, 5:])]:
+        offset, scale = unorm_bounds(values)
+        base['uv' if name == 'texcoord' else name] = np.rint((values - offset) / scale)
+        uniforms[f'u_{name}_offset'], uniforms[f'u_{name}_scale'] = offset, scale
+    base['normal'] = np.rint(octahedral(vertices[:, 2:5]) * 32767)
+    rows = []
+    for i, end_vertices in enumerate(targets, start=1):
+        deltas = np.asarray(end_vertices, dtype='f8').reshape(-1, 8)[:, 2:] - vertices[:, 2:]
+        target = np.zeros(len(vertices), dtype=COMPACT_TARGET_DTYPE)
+        for name, values, limit in [('normal', deltas[:, :3], 127), ('position', deltas[:, 3:], 32767)]:
+            scale = np.maximum(np.abs(values).max(axis=0), 1e-12) / limit
+            target[name] = np.rint(values / scale)
+            uniforms[f'u_{name}_delta_scale_{i}'] = scale
+        rows.append(target)
+    uniforms = {name: tuple(float(x) for x in value) for name, value in uniforms.items()}
+    return base, rows, uniforms
+
+
+def decode_compact(base, rows, uniforms, weights):
+    # (texcoords, normals, positions) the shader computes for the morph weights
+    texcoords = uniforms['u_texcoord_offset'] + base['uv'] * np.array(uniforms['u_texcoord_scale'])
+    normals = decode_octahedral(base['normal'] / 32767)
+    positions = uniforms['u_position_offset'] + base['position'] * np.array(uniforms['u_position_scale'])
+    for i, (target, weight) in enumerate(zip(rows, weights), start=1):
+        normals = normals + weight * target['normal'] * np.array(uniforms[f'u_normal_delta_scale_{i}'])
+        positions = positions + weight * target['position'] * np.array(uniforms[f'u_position_delta_scale_{i}'])
+    return texcoords, normals / np.linalg.norm(normals, axis=1, keepdims=True), positions
+
+
+def report(path, target_paths, texture_size=2048):
+    # GPU bytes of the float and compact formats and the error of the compact one
+    _, vertex_data, targets = load_indexed_mesh(path, target_paths)
+    base, rows, uniforms = compact_mesh(vertex_data, targets)
+    count = len(base)
+    before = count * 4 * (8 + 6 * len(targets))
+    after = base.nbytes + sum(row.nbytes for row in rows)
+    print(f'{path}: {count} vertices, {before / 1024:.0f} KB float -> {after / 1024:.0f} KB compact ({after / before:.0%})')
+    vertices = np.asarray(vertex_data, dtype='f8').reshape(-1, 8)
+    extent = np.ptp(vertices[:, 5:], axis=0).max()
+    for i in range(len(targets) + 1):
+        weights = np.eye(len(targets))[i - 1] if i else np.zeros(len(targets))
+        exact = vertices + sum(w * (np.asarray(t, dtype='f8').reshape(-1, 8) - vertices) for w, t in zip(weights, targets))
+        texcoords, normals, positions = decode_compact(base, rows, uniforms, weights)
+        exact_normals = exact[:, 2:5] / np.linalg.norm(exact[:, 2:5], axis=1, keepdims=True)
+        angle = np.degrees(np.arccos(np.clip((normals * exact_normals).sum(axis=1), -1, 1)))
+        distance = np.linalg.norm(positions - exact[:, 5:], axis=1)
+        texels = np.abs(texcoords - exact[:, :2]).max() * texture_size
+        name = target_paths[i - 1] if i else 'base'
+        print(f'  {name}: position error max {distance.max():.2e} ({distance.max() / extent:.1e} of the mesh), '
+              f'normal error max {angle.max():.3f} deg mean {angle.mean():.3f} deg, uv error max {texels:.3f} texels')
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or list(MORPH_SETS)
+    for path in paths:
+        report(path, MORPH_SETS.get(path, []))
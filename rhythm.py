@@ -0,0 +1,99 @@
+import numpy as np
+
+# beat masks: one amplitude per beat (1 = full contraction, 0 = skipped beat), the
+# heart reads the next one each time its cycle wraps. Everything here is drawn from
+# an explicit seed (an int, None or a np.random.Generator) so the patients can be
+# reproduced, and vectorized over patients so a whole ward is a single call
+
+MASK_LENGTH = 100
+STREAM_BLOCK = 240  # beats generated per step of stream(), a multiple of SMOOTHING_STEPS
+SMOOTHING_STEPS = 5
+
+
+def steady_masks(rng, count, length, state=None):
+    return np.ones((count, length), dtype='f4'), state
+
+
+def smoothed_masks(rng, count, length, state=None, beat_range=(0.7, 1.0), pause_range=(0.0, 0.3),
+                   beat_probability=0.6, steps=SMOOTHING_STEPS):
+    # random targets, a beat or a pause, with a linear ramp of `steps` beats towards each one
+    # (state: the last target of each patient, so consecutive blocks join smoothly)
+    segments = -(-length // steps)
+    beats = rng.random((count, segments)) < beat_probability
+    targets = np.where(beats, rng.uniform(*beat_range, (count, segments)), rng.uniform(*pause_range, (count, segments)))
+    if state is None:
+        state = rng.uniform(*pause_range, count)
+    previous = np.concatenate([state[:, None], targets[:, :-1]], axis=1)
+    ramp = np.arange(steps) / steps
+    masks = previous[:, :, None] + (targets - previous)[:, :, None] * ramp
+    return masks.reshape(count, -1)[:, :length].astype('f4'), targets[:, -1]
+
+
+def fibrillation_masks(rng, count, length, state=None, amplitude_range=(0.3, 1.0)):
+    # irregularly irregular: every beat has its own strength, no pattern between them
+    return rng.uniform(*amplitude_range, (count, length)).astype('f4'), state
+
+
+def ectopic_masks(rng, count, length, state=None, probability=0.08, amplitude_range=(0.4, 0.6)):
+    # normal beats with premature weak ones, each followed by a compensatory pause
+    # (state: whether the last beat of each patient was ectopic)
+    ectopic = rng.random((count, length)) < probability
+    pause = np.zeros_like(ectopic)
+    pause[:, 1:] = ectopic[:, :-1]
+    if state is not None:
+        pause[:, 0] = state
+    ectopic &= ~pause
+    masks = np.ones((count, length), dtype='f4')
+    masks[ectopic] = rng.uniform(*amplitude_range, np.count_nonzero(ectopic))
+    masks[pause] = 0.0
+    return masks, ectopic[:, -1]
+
+
+# name -> (ppm range, both ends included, beat mask generator, beat to beat ppm variation)
+RHYTHMS = {
+    'Normal': ((60, 100), steady_masks, 0.03),
+    'Bradicardia': ((30, 60), steady_masks, 0.03),
+    'Taquicardia': ((110, 160), steady_masks, 0.03),
+    'Arritmia': ((60, 100), smoothed_masks, 0.03),
+    'Fibrilacion': ((100, 160), fibrillation_masks, 0.25),
+    'Extrasistole': ((60, 100), ectopic_masks, 0.03),
+}
+
+
+def get_rhythm(kind):
+    if kind not in RHYTHMS:
+        raise ValueError(f'unknown rhythm {kind!r}, expected one of {", ".join(RHYTHMS)}')
+    return RHYTHMS[kind]
+
+
+def generate(kinds, length=MASK_LENGTH, seed=None):
+    # ppm (count,) and beat masks (count, length) for one patient per entry of kinds,
+    # each rhythm drawn for all its patients at once
+    rng = np.random.default_rng(seed)
+    kinds = np.asarray(kinds)
+    ppm = np.empty(len(kinds), dtype=int)
+    masks = np.empty((len(kinds), length), dtype='f4')
+    for kind in np.unique(kinds):
+        (low, high), get_masks, _ = get_rhythm(kind)
+        patients = np.flatnonzero(kinds == kind)
+        ppm[patients] = rng.integers(low, high, len(patients), endpoint=True)
+        masks[patients] = get_masks(rng, len(patients), length)[0]
+    return ppm, masks
+
+
+def ppm_schedule(kinds, ppm, length=MASK_LENGTH, seed=None):
+    # beat to beat rate (count, length) around each patient's ppm
+    rng = np.random.default_rng(seed)
+    variation = np.array([get_rhythm(kind)[2] for kind in kinds])[:, None]
+    jitter = rng.uniform(-1.0, 1.0, (len(kinds), length)) * variation
+    return np.maximum(np.rint(np.asarray(ppm)[:, None] * (1 + jitter)), 1).astype(int)
+
+
+def stream(kind, seed=None, block=STREAM_BLOCK):
+    # endless beat mask of a single patient, only one block of beats in memory at a time
+    rng = np.random.default_rng(seed)
+    get_masks = get_rhythm(kind)[1]
+    state = None
+    while True:
+        masks, state = get_masks(rng, 1, block, state)
+        yield from masks[0].tolist()
@@ -1,29 +1,81 @@
 from model import *
+from assets import AssetRegistry
+from partition import PartitionedHeart
+from ward import HeartWard
 import random
 
 
 class Scene:
-    def __init__(self, app, models_data):
+    def __init__(self, app, models_data, ward=False, prefetched=None, partitioned=False):
         self.app = app
+        # ward: every model is a patient of one instanced HeartWard
+        self.ward = ward
+        # partitioned: the hearts are PartitionedHeart (one sub-mesh and texture per region)
+        self.partitioned = partitioned
         self.objects = []
+        # programs, textures and meshes shared by every heart in the scene, kept
+        # loaded across reload() until the scene is destroyed
+        self.assets = AssetRegistry(app.ctx, prefetched, retain=True)
+        # (EcgPlayback, heart) pairs, the recording drives the heart's rhythm
+        self.recordings = []
         self.load(models_data)
 
 
     def add_object(self, obj):
         self.objects.append(obj)
 
+    def attach_recording(self, playback, obj):
+        self.recordings.append((playback, obj))
+
+    def close_recordings(self):
+        for playback, _ in self.recordings:
+            playback.close()
+        self.recordings.clear()
+
     def load(self, models_data):
         app = self.app
         add = self.add_object
+        if self.ward:
+            add(HeartWard(app, models_data, assets=self.assets))
+            return
+        heart = PartitionedHeart if self.partitioned else Heart
         for data in models_data:
             pos, rot, scale, ppm, mask = data[0], data[1], data[2], data[3], data[4], 
-            add(Heart(app, pos, rot, scale, ppm, mask))
+            add(heart(app, pos, rot, scale, ppm, mask, assets=self.assets))
+
+    def reload(self, models_data, ward=None):
+        # swap the hearts for a new set, the assets both sets use stay loaded in between
+        self.close_recordings()
+        for obj in self.objects:
+            obj.destroy()
+        self.objects.clear()
+        if ward is not None:
+            self.ward = ward
+        self.load(models_data)
+        # what the new hearts took again stays loaded, the rest of the old scene goes
+        self.assets.purge()
 
     def render(self):
         for obj in self.objects:
             obj.render()
 
-    def animate(self):
+    def animate(self, steps=1, alpha=1.0):
+        # steps of the simulation clock, then each heart's mesh for a frame alpha of the
+        # way between the last two steps
+        profiler = self.app.profiler
+        for _ in range(steps):
+            for playback, obj in self.recordings:
+                playback.advance(obj)
+            for obj in self.objects:
+                obj.step()
+        for i, obj in enumerate(self.objects):
+            with profiler.stage(f'animate heart {i}'):
+                obj.animate(alpha)
+
+    def destroy(self):
+        self.close_recordings()
         for obj in self.objects:
-            obj.animate()
+            obj.destroy()
+        self.objects.clear()
+        self.assets.destroy()
          
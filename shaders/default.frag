@@ -15,7 +15,12 @@ struct Light {
 
 uniform Light light;
 uniform sampler2D u_texture_0;
-uniform vec3 camPos;
+
+layout (std140) uniform Camera {
+    mat4 m_proj;
+    mat4 m_view;
+    vec3 camPos;
+};
 
 
 vec3 getLight(vec3 color) {
@@ -1,21 +1,42 @@
 #version 330 core
 
-layout (location = 0) in vec2 in_texcoord_0;
-layout (location = 1) in vec3 in_normal;
-layout (location = 2) in vec3 in_position;
+#include "morph_vertex.glsl"
 
 out vec2 uv_0;
 out vec3 normal;
 out vec3 fragPos;
 
-uniform mat4 m_proj;
-uniform mat4 m_view;
+// shared by every program, one per view (camera.py)
+layout (std140) uniform Camera {
+    mat4 m_proj;
+    mat4 m_view;
+    vec3 camPos;
+};
 uniform mat4 m_model;
+// transpose(inverse(mat3(m_model))), computed on the CPU when the model matrix changes
+uniform mat3 m_normal;
+// blend weight of each morph target (zero when the mesh is blended on the CPU)
+uniform vec3 u_morph;
+#ifdef BAKED_KEYFRAMES
+// morph weights of one beat at KEYFRAME_COUNT + 1 evenly spaced phases (keyframes.py)
+uniform vec3 u_keyframes[KEYFRAME_COUNT + 1];
+// phase of the frame, amplitude of the beat
+uniform vec2 u_beat;
+#endif
 
 
 void main() {
-    uv_0 = in_texcoord_0;
-    fragPos = vec3(m_model * vec4(in_position, 1.0));
-    normal = mat3(transpose(inverse(m_model))) * normalize(in_normal);
-    gl_Position = m_proj * m_view * m_model * vec4(in_position, 1.0);
-}
\ No newline at end of file
+#ifdef BAKED_KEYFRAMES
+    float key = u_beat.x * float(KEYFRAME_COUNT);
+    int previous = min(int(key), KEYFRAME_COUNT - 1);
+    vec3 weights = u_beat.y * mix(u_keyframes[previous], u_keyframes[previous + 1], key - float(previous));
+#else
+    vec3 weights = u_morph;
+#endif
+    vec3 position, morph_normal;
+    morph_vertex(weights, position, morph_normal, uv_0);
+
+    fragPos = vec3(m_model * vec4(position, 1.0));
+    normal = m_normal * normalize(morph_normal);
+    gl_Position = m_proj * m_view * m_model * vec4(position, 1.0);
+}
@@ -0,0 +1,12 @@
+#version 330 core
+layout (location = 0) in vec2 in_position;
+
+out vec2 uv_0;
+
+// x, y, width, height in normalized device coordinates
+uniform vec4 u_rect;
+
+void main() {
+    uv_0 = in_position;
+    gl_Position = vec4(u_rect.xy + in_position * u_rect.zw, 0.0, 1.0);
+}
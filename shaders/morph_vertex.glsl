@@ -0,0 +1,67 @@
+// vertex inputs and morph blend shared by default.vert and ward.vert, pasted in place of
+// their #include line when the program is built (model.py add_includes)
+#ifdef COMPACT_VERTICES
+// compact format (quantize.py): uint16 uv and position over their bounds, octahedral int16
+// normal, morph deltas as int8 normal and int16 position scaled per target
+layout (location = 0) in uvec2 in_texcoord_0;
+layout (location = 1) in ivec2 in_normal;
+layout (location = 2) in uvec3 in_position;
+
+layout (location = 3) in ivec3 in_normal_1;
+layout (location = 4) in ivec3 in_position_1;
+layout (location = 5) in ivec3 in_normal_2;
+layout (location = 6) in ivec3 in_position_2;
+layout (location = 7) in ivec3 in_normal_3;
+layout (location = 8) in ivec3 in_position_3;
+
+uniform vec2 u_texcoord_offset;
+uniform vec2 u_texcoord_scale;
+uniform vec3 u_position_offset;
+uniform vec3 u_position_scale;
+uniform vec3 u_normal_delta_scale_1;
+uniform vec3 u_position_delta_scale_1;
+uniform vec3 u_normal_delta_scale_2;
+uniform vec3 u_position_delta_scale_2;
+uniform vec3 u_normal_delta_scale_3;
+uniform vec3 u_position_delta_scale_3;
+
+vec3 octahedral(vec2 e) {
+    vec3 n = vec3(e, 1.0 - abs(e.x) - abs(e.y));
+    if (n.z < 0.0) {
+        n.xy = (1.0 - abs(n.yx)) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+    }
+    return normalize(n);
+}
+#else
+layout (location = 0) in vec2 in_texcoord_0;
+layout (location = 1) in vec3 in_normal;
+layout (location = 2) in vec3 in_position;
+
+// morph targets stored as deltas against the base mesh
+layout (location = 3) in vec3 in_normal_1;
+layout (location = 4) in vec3 in_position_1;
+layout (location = 5) in vec3 in_normal_2;
+layout (location = 6) in vec3 in_position_2;
+layout (location = 7) in vec3 in_normal_3;
+layout (location = 8) in vec3 in_position_3;
+#endif
+
+// position, normal (not normalized) and texcoord of the vertex with each morph target
+// blended in by its weight
+void morph_vertex(vec3 weights, out vec3 position, out vec3 morph_normal, out vec2 uv) {
+#ifdef COMPACT_VERTICES
+    position = u_position_offset + vec3(in_position) * u_position_scale
+             + weights.x * vec3(in_position_1) * u_position_delta_scale_1
+             + weights.y * vec3(in_position_2) * u_position_delta_scale_2
+             + weights.z * vec3(in_position_3) * u_position_delta_scale_3;
+    morph_normal = octahedral(vec2(in_normal) / 32767.0)
+                 + weights.x * vec3(in_normal_1) * u_normal_delta_scale_1
+                 + weights.y * vec3(in_normal_2) * u_normal_delta_scale_2
+                 + weights.z * vec3(in_normal_3) * u_normal_delta_scale_3;
+    uv = u_texcoord_offset + vec2(in_texcoord_0) * u_texcoord_scale;
+#else
+    position = in_position + weights.x * in_position_1 + weights.y * in_position_2 + weights.z * in_position_3;
+    morph_normal = in_normal + weights.x * in_normal_1 + weights.y * in_normal_2 + weights.z * in_normal_3;
+    uv = in_texcoord_0;
+#endif
+}
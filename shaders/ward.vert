@@ -0,0 +1,31 @@
+#version 330 core
+
+#include "morph_vertex.glsl"
+
+// per patient: model matrix and blend weight of each morph target
+layout (location = 9) in mat4 in_model;
+layout (location = 13) in vec3 in_morph;
+
+out vec2 uv_0;
+out vec3 normal;
+out vec3 fragPos;
+
+// shared by every program, one per view (camera.py)
+layout (std140) uniform Camera {
+    mat4 m_proj;
+    mat4 m_view;
+    vec3 camPos;
+};
+// rotation shared by the whole ward; the ward scales every patient uniformly, so it is
+// also the normal matrix up to a length that normalize() drops
+uniform mat3 m_normal;
+
+
+void main() {
+    vec3 position, morph_normal;
+    morph_vertex(in_morph, position, morph_normal, uv_0);
+
+    fragPos = vec3(in_model * vec4(position, 1.0));
+    normal = m_normal * normalize(morph_normal);
+    gl_Position = m_proj * m_view * in_model * vec4(position, 1.0);
+}
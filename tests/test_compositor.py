@@ -0,0 +1,42 @@
+import os
+from types import SimpleNamespace
+import pygame as pg
+from compositor import CompositorEngine
+from profiler import FrameProfiler, ProfilerHud
+
+
+class KeyCompositor:
+    # stand-in for the panes: posts the keys pressed during each frame and draws nothing
+    def __init__(self, keys):
+        self.keys = keys
+        self.frame = -1
+
+    def compose(self, target):
+        self.frame += 1
+        for key in self.keys.get(self.frame, ()):
+            pg.event.post(pg.event.Event(pg.KEYDOWN, key=key))
+        return self.frame
+
+
+def test_toggle_profiler_mid_run():
+    os.environ.setdefault('SDL_VIDEODRIVER', 'offscreen')
+    pg.display.init()
+    try:
+        pg.display.set_mode((64, 64))
+        engine = CompositorEngine.__new__(CompositorEngine)
+        engine.ctx = SimpleNamespace(screen=None)
+        engine.clock = pg.time.Clock()
+        engine.fps = 0
+        engine.profiler = FrameProfiler(None)
+        hud = SimpleNamespace(profiler=engine.profiler, visible=False, render=lambda: None)
+        hud.toggle = lambda: ProfilerHud.toggle(hud)
+        engine.hud = hud
+        # the keys are read at the start of the next frame, after begin_frame
+        engine.compositor = KeyCompositor({0: [pg.K_F3], 2: [pg.K_F3], 3: [pg.K_F3], 5: [pg.K_ESCAPE]})
+        engine.run()
+        assert engine.compositor.frame == 6 and hud.visible
+        # on in frame 1 (dropped), 2 and 3 recorded, off in 4, on again in 5 (dropped), 6 recorded
+        assert len(engine.profiler.frames) == 3
+        assert all({'frame', 'flip', 'tick'} <= set(record) for record in engine.profiler.frames)
+    finally:
+        pg.display.quit()
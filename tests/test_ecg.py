@@ -0,0 +1,32 @@
+import numpy as np
+from clock import SIMULATION_RATE
+from ecg import ECG_RATE, EcgPlayback, detect, synthetic_ecg
+from model import Heart
+
+
+def test_beats_on_the_r_peaks(tmp_path):
+    path = str(tmp_path / 'record.dat')
+    samples, _ = synthetic_ecg(120, ppm=72, variability=0.15, seed=0)
+    samples.tofile(path)
+    peaks = detect(path)[0] / ECG_RATE
+    # a small chunk: peaks are also detected across chunk boundaries
+    playback = EcgPlayback(path, chunk=4096)
+    heart = Heart.__new__(Heart)  # only its animation state, no GL
+    heart.morph = 'cpu'
+    heart.update_animation_params(72, [1.0])
+    heart.animation_progress_1 = heart.animation_progress_2 = heart.animation_progress_3 = 0.0
+    heart.beat_count = 0
+    # the scene's order: the recording, then the heart's step
+    wraps = []
+    for step in range(1, 120 * SIMULATION_RATE + 1):
+        playback.advance(heart)
+        beats = heart.beat_count
+        heart.step()
+        if heart.beat_count > beats:
+            wraps.append(step / SIMULATION_RATE)
+    playback.close()
+    # every cycle from the first peak on wraps in the step that reaches a peak
+    wraps = np.array(wraps)
+    wraps = wraps[wraps >= peaks[0]]
+    assert len(wraps) == len(peaks)
+    assert np.abs(wraps - peaks).max() <= 1 / SIMULATION_RATE + 1e-9
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+from profiler import FrameProfiler, ProfilerHud
+
+
+def run_frames(profiler, toggles, frames=6):
+    # the main loop's order: begin_frame, events (F3 toggles the HUD), stages, end_frame
+    hud = SimpleNamespace(profiler=profiler, visible=False)
+    for frame in range(frames):
+        profiler.begin_frame()
+        with profiler.stage('events'):
+            if frame in toggles:
+                ProfilerHud.toggle(hud)
+        with profiler.stage('animate'):
+            pass
+        profiler.end_frame()
+    return hud
+
+
+def test_toggle_on_mid_frame():
+    profiler = FrameProfiler(None)
+    hud = run_frames(profiler, toggles={2})
+    assert hud.visible and profiler.enabled
+    # the frame it was switched on in is dropped, the next ones are recorded
+    assert len(profiler.frames) == 3
+    assert all({'frame', 'events', 'animate'} <= set(record) for record in profiler.frames)
+
+
+def test_toggle_on_and_off_mid_run():
+    profiler = FrameProfiler(None)
+    hud = run_frames(profiler, toggles={1, 3, 4})
+    assert hud.visible and profiler.enabled
+    # on in frame 1 (dropped), 2 recorded, off in 3 (dropped), on again in 4 (dropped), 5 recorded
+    assert len(profiler.frames) == 2
+    assert profiler.record == {}
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+import pygame as pg
+from mesh_cache import CACHE_DIR, cache_path, source_hash, store
+
+# decoded textures live next to the compiled meshes: one (height, width, 3) uint8 .npy per
+# image and content hash, rows already flipped for OpenGL, memory-mapped on load
+
+# widest row of an atlas, the images are packed in rows of at most this many texels
+ATLAS_WIDTH = 8192
+# texels around each image in an atlas repeating its edge, so filtering at a uv border
+# reads the image's own edge and not its neighbour's; a mip level of the atlas still has
+# a texel of it up to ATLAS_LEVELS, the coarser levels are not built
+ATLAS_PADDING = 32
+ATLAS_LEVELS = 5
+
+
+def decode_texture(path):
+    # (size, RGB bytes) flipped for OpenGL, safe to run off the GL thread
+    # no convert(): decoding must not depend on a display (headless rendering)
+    texture = pg.image.load(path)
+    texture = pg.transform.flip(texture, flip_x=False, flip_y=True)
+    return texture.get_size(), pg.image.tostring(texture, 'RGB')
+
+
+def compile_texture(path, cached=None):
+    cached = cached or cache_path(path, source_hash(path))
+    (width, height), data = decode_texture(path)
+    image = np.frombuffer(data, dtype='u1').reshape(height, width, 3)
+    store(cached, image)
+    return image
+
+
+def load_texture(path):
+    # mmap the decoded image, decoding it first if the source changed
+    cached = cache_path(path, source_hash(path))
+    if not os.path.exists(cached):
+        compile_texture(path, cached)
+    return np.load(cached, mmap_mode='r')
+
+
+def atlas_layout(sizes, max_width=ATLAS_WIDTH, padding=ATLAS_PADDING):
+    # (atlas size, (x, y) of each image) packing the padded images in rows, left to right
+    # and bottom to top; texture space starts at the bottom row like the flipped images
+    x = y = row_height = width = 0
+    offsets = []
+    for image_width, image_height in sizes:
+        cell_width, cell_height = image_width + 2 * padding, image_height + 2 * padding
+        if x and x + cell_width > max_width:
+            x, y, row_height = 0, y + row_height, 0
+        offsets.append((x + padding, y + padding))
+        x += cell_width
+        width = max(width, x)
+        row_height = max(row_height, cell_height)
+    return (width, y + row_height), offsets
+
+
+def atlas_texcoords(texcoords, size, offset, atlas_size):
+    # uv of an image placed at offset in the atlas
+    return ((np.asarray(offset) + np.asarray(texcoords) * size) / atlas_size).astype('f4')
+
+
+def load_atlas(paths, name):
+    # the images packed by atlas_layout in one image, cached under name
+    key = ''.join(source_hash(p) for p in paths) + repr((ATLAS_WIDTH, ATLAS_PADDING))
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    cached = cache_path(name, digest)
+    if not os.path.exists(cached):
+        images = [load_texture(path) for path in paths]
+        (width, height), offsets = atlas_layout([image.shape[1::-1] for image in images])
+        atlas = np.zeros((height, width, 3), dtype='u1')
+        p = ATLAS_PADDING
+        for image, (x, y) in zip(images, offsets):
+            atlas[y - p:y + image.shape[0] + p, x - p:x + image.shape[1] + p] = np.pad(image, ((p, p), (p, p), (0, 0)), mode='edge')
+        store(cached, atlas)
+    return np.load(cached, mmap_mode='r')
+
+
+def prebuild(root='objects'):
+    # decode every PNG under root and report cold (decode) and warm (mmap) load times
+    for folder, _, files in os.walk(root):
+        if os.path.abspath(folder).startswith(os.path.abspath(CACHE_DIR)):
+            continue
+        for name in sorted(files):
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(folder, name)
+            start = time.perf_counter()
+            image = compile_texture(path)
+            cold = time.perf_counter() - start
+            start = time.perf_counter()
+            np.asarray(load_texture(path)).sum()
+            warm = time.perf_counter() - start
+            print(f'{path}: {image.shape[1]}x{image.shape[0]}, cold {cold * 1000:.1f} ms, warm {warm * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    prebuild(*sys.argv[1:])
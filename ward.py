@@ -0,0 +1,178 @@
+import glm
+import numpy as np
+from camera import CAMERA_BINDING, CAMERA_BLOCK
+from clock import SIMULATION_RATE
+from model import Heart, add_defines, add_includes
+
+
+class WardBeat:
+    # Heart.update_progress / get_morph_weights for many patients at once
+    def __init__(self, ppm, masks, phase):
+        # a ppm or a schedule of one per beat (rhythm.ppm_schedule) per patient, padded like the masks
+        schedules = [np.atleast_1d(p) for p in ppm]
+        self.schedule_length = np.array([len(schedule) for schedule in schedules])
+        self.ppm_schedule = np.zeros((len(schedules), self.schedule_length.max()))
+        for i, schedule in enumerate(schedules):
+            self.ppm_schedule[i, :len(schedule)] = schedule
+        self.ppm = self.ppm_schedule[:, 0].copy()
+        self.beat_count = np.zeros(len(self.ppm), dtype=int)
+        # masks of different length are padded, tempo wraps at each patient's own length
+        self.mask_length = np.array([len(mask) for mask in masks])
+        self.beat_mask = np.zeros((len(masks), self.mask_length.max()))
+        for i, mask in enumerate(masks):
+            self.beat_mask[i, :len(mask)] = mask
+        self.animation_progress_1 = np.asarray(phase, dtype='f8').copy()
+        self.animation_progress_2 = np.zeros_like(self.ppm)
+        self.animation_progress_3 = np.zeros_like(self.ppm)
+        self.tempo = np.zeros(len(self.ppm), dtype=int)
+        self.weights = np.zeros((len(self.ppm), 3), dtype='f4')
+        self.previous_weights = np.zeros_like(self.weights)  # before the last update
+
+    def update(self, factor_1=1 / SIMULATION_RATE, factor_2=0.0067):
+        step_1 = (self.ppm * factor_1) / 60
+        step_2 = (self.ppm * factor_2) / 60
+        p1, p2, p3 = self.animation_progress_1, self.animation_progress_2, self.animation_progress_3
+
+        self.previous_weights[:] = self.weights
+        p1 += step_1
+        beat = p1 >= 1.0
+        p1[beat] -= 1.0
+        self.tempo[beat] += 1
+        self.tempo[self.tempo == self.mask_length] = 0
+        self.beat_count[beat] += 1
+        self.ppm[beat] = self.ppm_schedule[beat, self.beat_count[beat] % self.schedule_length[beat]]
+
+        systole = p1 >= 0.5
+        p2 += np.where(systole & (p2 < 1.0), step_2, 0.0) - np.where(~systole & (p2 > 0.0), step_2, 0.0)
+        arteries = p1 >= 0.75
+        p3 += np.where(arteries & (p3 < 1.0), step_1, 0.0) - np.where(~arteries & (p3 > 0.0), step_1, 0.0)
+
+        amplitude = self.beat_mask[np.arange(len(self.tempo)), self.tempo]
+        blend_factor_step2 = np.minimum(p2 * 2, 1.0)
+        blend_factor_step3 = np.minimum(p3 * 2, 1.0)
+        self.weights[:, 0] = (1 - blend_factor_step2 - blend_factor_step3) * p1 * amplitude
+        self.weights[:, 1] = blend_factor_step2 * p2 * amplitude
+        self.weights[:, 2] = blend_factor_step3 * p3 * amplitude
+
+
+class HeartWard(Heart):
+    # a grid of patients drawn with one instanced call: every instance shares the
+    # static base/morph buffers and gets its model matrix and morph weights per instance
+    program_name = 'ward'
+
+    def __init__(self, app, models_data, assets=None, vertex_format=None):
+        self.count = len(models_data)
+        self.positions = np.array([data[0] for data in models_data], dtype='f4')
+        self.scales = np.array([data[2] for data in models_data], dtype='f4')
+        phases = [data[5] if len(data) > 5 else 0.0 for data in models_data]
+        self.beats = WardBeat([data[3] for data in models_data], [data[4] for data in models_data], phases)
+        # 16 floats of model matrix + 3 morph weights per patient
+        self.instance_data = np.zeros((self.count, 19), dtype='f4')
+        # weights of the frame, between the last two updates of the beats
+        self.frame_weights = np.zeros((self.count, 3), dtype='f4')
+        self.instance_vbo = app.ctx.buffer(self.instance_data, dynamic=True)
+        super().__init__(app, rot=models_data[0][1], morph='gpu', assets=assets, vertex_format=vertex_format)
+        self.update_instances()
+
+    def get_program(self, shader_program_name):
+        # instanced vertex stage, same lighting as the single heart
+        with open(f'shaders/{shader_program_name}.vert') as file:
+            vertex_shader = add_defines(add_includes(file.read()), self.defines)
+
+        with open('shaders/default.frag') as file:
+            fragment_shader = file.read()
+
+        return self.ctx.program(vertex_shader=vertex_shader, fragment_shader=fragment_shader)
+
+    def get_vao(self, content, ibo):
+        content = [*content, (self.instance_vbo, '16f 3f/i', 'in_model', 'in_morph')]
+        return super().get_vao(content, ibo)
+
+    def get_bounds(self):
+        # one patient in the middle of the ward, they all have about the same size on screen
+        center, radius = self.bounds
+        return glm.vec3(*self.positions.mean(axis=0)), radius * float(self.scales.max())
+
+    def get_state(self):
+        weights = self.frame_weights
+        return tuple(self.rot), np.where(np.abs(weights) > 1e-6, weights, 0.0).tobytes()
+
+    def update_instances(self):
+        rotated = tuple(self.rot) != self.model_state
+        if rotated:
+            self.model_state = tuple(self.rot)
+            # model matrix = translate(pos) * rotation shared by the whole ward * scale(scale)
+            m_rot = self.get_rotation_matrix()
+            rotation = np.array(m_rot, dtype='f4')
+            # instance matrices are stored column-major like glm, model[i, column, row]
+            model = self.instance_data[:, :16].reshape(-1, 4, 4)
+            model[:, :3, :3] = rotation[None, :3, :3].transpose(0, 2, 1) * self.scales[:, :, None]
+            model[:, 3, :3] = self.positions
+            model[:, 3, 3] = 1.0
+            self.program['m_normal'].write(glm.mat3(m_rot))
+        # a ward at rest (every patient in a pause) uploads nothing
+        if rotated or not np.array_equal(self.instance_data[:, 16:], self.frame_weights):
+            self.instance_data[:, 16:] = self.frame_weights
+            with self.app.profiler.stage('upload'):
+                self.instance_vbo.write(self.instance_data)
+
+    def get_rotation_matrix(self):
+        m_rot = glm.rotate(glm.mat4(), self.rot.z, glm.vec3(0, 0, 1))
+        m_rot = glm.rotate(m_rot, self.rot.y, glm.vec3(0, 1, 0))
+        return glm.rotate(m_rot, self.rot.x, glm.vec3(1, 0, 0))
+
+    def on_init(self):
+        # texture
+        self.program['u_texture_0'] = 0
+        # view and projection come from the camera's uniform block
+        self.program[CAMERA_BLOCK].binding = CAMERA_BINDING
+        self.m_proj = glm.mat4(self.camera.m_proj)
+        # light
+        self.program['light.Ia'].write(self.app.light.Ia)
+        self.program['light.Id'].write(self.app.light.Id)
+        self.program['light.Is'].write(self.app.light.Is)
+
+    def update(self):
+        if self.changed(('texture', 0), self.texture):
+            self.texture.use()
+        if self.compact_uniforms and self.changed((self.program, 'compact'), self.mesh_path):
+            self.write_compact_uniforms()
+
+    def render(self):
+        self.update()
+        self.vao = self.vaos[self.select_lod()]
+        self.vao.render(instances=self.count)
+
+    def step(self):
+        self.beats.update()
+
+    def animate(self, alpha=1.0):
+        beats = self.beats
+        if alpha < 1.0:
+            np.subtract(beats.weights, beats.previous_weights, out=self.frame_weights)
+            self.frame_weights *= alpha
+            self.frame_weights += beats.previous_weights
+        else:
+            self.frame_weights[:] = beats.weights
+        if self.app.interactive:
+            self.update_rotation()
+        self.update_instances()
+
+    def destroy(self):
+        self.instance_vbo.release()
+        super().destroy()
+
+
+def ward_layout(count, center=(0, -2, -10), width=6.4, height=3.6):
+    # (positions, scale) of a count-patient grid that fits the default perspective view
+    cols = int(np.ceil(np.sqrt(count * width / height)))
+    rows = int(np.ceil(count / cols))
+    cell = min(width / cols, height / rows)
+    scale = cell / 1.7  # the heart mesh is ~1.2 wide and ~1.5 tall
+    positions = []
+    for i in range(count):
+        row, col = divmod(i, cols)
+        x = center[0] + (col - (cols - 1) / 2) * cell
+        y = center[1] + ((rows - 1) / 2 - row) * cell
+        positions.append((x, y, center[2]))
+    return positions, (scale, scale, scale)